@@ -1,5 +1,5 @@
 # app_optimized.py - High-performance Flask application
-from flask import Flask, request, jsonify, session
+from flask import Flask, Response, request, jsonify, session
 from flask_cors import CORS
 import os
 import uuid
@@ -8,20 +8,30 @@ import asyncio
 from concurrent.futures import ThreadPoolExecutor
 import threading
 import sys
+import weakref
+import logging
+from collections import OrderedDict
 
 # Check if optimized AI core exists, fallback to regular if not
 try:
-    from ai_core_optimized import run_agent_optimized, run_agent_async
+    from ai_core_optimized import run_agent_optimized, run_agent_async, llm_manager
     print("✅ Using optimized AI core")
 except ImportError:
     print("⚠️  Optimized AI core not found, falling back to regular AI core")
     from ai_core import run_agent
     run_agent_optimized = run_agent
+    llm_manager = None
     
     # Create a simple async wrapper
     async def run_agent_async(user_input: str, thread_id: str = "default"):
         return run_agent(user_input, thread_id)
 
+# GitHub AI models are optional - resolved once here rather than per /models request
+try:
+    from ai_core_github_integration import get_github_ai_models
+except ImportError:
+    get_github_ai_models = None
+
 # Import MongoDB-based managers (required)
 try:
     from chat_session_manager_mongodb import MongoChatSessionManager
@@ -36,6 +46,17 @@ except ImportError as e:
     MONGODB_AVAILABLE = False
     print("✅ Using file-based storage")
 
+# Configure logging once for the whole app; modules log via logging.getLogger(__name__)
+logging.basicConfig(
+    level=os.environ.get("LOG_LEVEL", "INFO").upper(),
+    format="%(asctime)s %(levelname)s %(name)s: %(message)s"
+)
+log = logging.getLogger(__name__)
+
+def _tok_prefix(auth_token):
+    """Shorten an auth token for logging"""
+    return auth_token[:8] if auth_token and len(auth_token) > 8 else auth_token
+
 # ------------------------------------------------------------------
 # 1. OPTIMIZED FLASK APP SETUP
 # ------------------------------------------------------------------
@@ -160,6 +181,38 @@ except (ImportError, ConnectionError, Exception) as e:
         user_manager = MinimalUserManager()
         print("⚠️ Using minimal fallback managers - limited functionality")
 
+# Token -> user lookups are cached briefly so repeated requests from the same
+# client skip the database round trip. Only successful lookups are cached, so a
+# token that starts working (or a transient miss) is retried on the next request.
+USER_CACHE_TTL = 30  # seconds
+USER_CACHE_SIZE = 10000
+_user_cache = OrderedDict()  # auth_token -> (expires_at, user_data)
+_user_cache_lock = threading.Lock()
+
+def _resolve_user(auth_token: str):
+    """Resolve an auth token to user data (cached for up to USER_CACHE_TTL seconds)"""
+    now = time.monotonic()
+    with _user_cache_lock:
+        entry = _user_cache.get(auth_token)
+        if entry is not None and entry[0] > now:
+            _user_cache.move_to_end(auth_token)
+            return dict(entry[1])
+    
+    user_data = user_manager.get_user_by_token(auth_token)
+    if not user_data:
+        return user_data
+    
+    with _user_cache_lock:
+        _user_cache[auth_token] = (now + USER_CACHE_TTL, dict(user_data))
+        _user_cache.move_to_end(auth_token)
+        while len(_user_cache) > USER_CACHE_SIZE:
+            _user_cache.popitem(last=False)
+    return user_data
+
+def _forget_user_token(auth_token: str):
+    """Drop a token from the lookup cache (e.g. on logout)"""
+    with _user_cache_lock:
+        _user_cache.pop(auth_token, None)
 
 # ------------------------------------------------------------------
 # 3. THREAD POOL FOR CONCURRENT PROCESSING
@@ -167,14 +220,33 @@ except (ImportError, ConnectionError, Exception) as e:
 
 executor = ThreadPoolExecutor(max_workers=5, thread_name_prefix="ai-worker")
 
+# Per-user cap on in-flight agent runs so one client can't monopolize the pool.
+# Weak values: a user's semaphore is dropped once none of their runs hold it
+MAX_CONCURRENT_PER_USER = 2
+_user_semaphores = weakref.WeakValueDictionary()
+_user_semaphores_lock = threading.Lock()
+
+def _get_user_semaphore(user_id: str) -> threading.Semaphore:
+    """Get or create the concurrency semaphore for a user"""
+    with _user_semaphores_lock:
+        sem = _user_semaphores.get(user_id)
+        if sem is None:
+            sem = _user_semaphores[user_id] = threading.Semaphore(MAX_CONCURRENT_PER_USER)
+        return sem
+
 # ------------------------------------------------------------------
 # 4. OPTIMIZED ENDPOINTS
 # ------------------------------------------------------------------
 
+# Pre-serialized health payload - only the timestamp changes per probe
+_HEALTH_PREFIX = b'{"status":"healthy","timestamp":'
+_HEALTH_SUFFIX = b'}'
+
 @app.route('/health', methods=['GET'])
 def health():
     """Ultra-fast health check"""
-    return {'status': 'healthy', 'timestamp': int(time.time())}, 200
+    body = _HEALTH_PREFIX + str(int(time.time())).encode() + _HEALTH_SUFFIX
+    return Response(body, status=200, mimetype='application/json')
 
 @app.route('/chat', methods=['POST'])
 def chat():
@@ -197,7 +269,7 @@ def chat():
         print(f"🔑 Using auth token for chat: {auth_token[:8]}...")
         
         # Get user from token
-        user_data = user_manager.get_user_by_token(auth_token)
+        user_data = _resolve_user(auth_token)
         if not user_data:
             print(f"❌ Invalid auth token: {auth_token[:8]}...")
             return {'error': 'Invalid authentication'}, 401
@@ -238,8 +310,20 @@ def chat():
         if forced_tool:
             print(f"🔧 FORCED TOOL: {forced_tool} | Session: {chat_session_id}")
         
-        # Submit to thread pool for processing with model selection
-        future = executor.submit(run_agent_optimized, user_input, chat_session_id, selected_model)
+        # Limit concurrent agent runs per user
+        user_sem = _get_user_semaphore(user_id)
+        if not user_sem.acquire(timeout=5):
+            return {'error': 'Too many concurrent requests. Please wait for your previous messages to finish.'}, 429
+        
+        try:
+            # Submit to thread pool for processing with model selection
+            future = executor.submit(run_agent_optimized, user_input, chat_session_id, selected_model)
+        except Exception:
+            user_sem.release()
+            raise
+        # Released when the run actually finishes - a timed-out run keeps
+        # executing and still counts against the user's limit
+        future.add_done_callback(lambda _: user_sem.release())
         
         # Wait for result with timeout
         try:
@@ -332,6 +416,9 @@ def register():
         print(f"❌ Registration error: {e}")
         return {'error': f'Server error: {str(e)}'}, 500
 
+# Pre-formatted auth cookie - only the token varies. Add "; Secure" in production with HTTPS.
+_AUTH_COOKIE_TEMPLATE = "auth_token=%s; HttpOnly; Max-Age=3600; Path=/"
+
 @app.route('/auth/login', methods=['POST'])
 def login():
     """Login a user"""
@@ -366,14 +453,7 @@ def login():
             })
             
             # Set auth token in a cookie as well (for redundancy)
-            response.set_cookie(
-                'auth_token',
-                user_data['auth_token'],
-                httponly=True,
-                samesite=None,
-                secure=False,  # Set to True in production with HTTPS
-                max_age=3600  # 1 hour
-            )
+            response.headers.add('Set-Cookie', _AUTH_COOKIE_TEMPLATE % user_data['auth_token'])
             
             return response
         except ValueError as e:
@@ -389,6 +469,7 @@ def logout():
         auth_token = session.get('auth_token')
         if auth_token:
             user_manager.logout_user(auth_token)
+            _forget_user_token(auth_token)
             session.pop('auth_token', None)
         
         return jsonify({'message': 'Logout successful'})
@@ -404,7 +485,7 @@ def get_current_user():
         if not auth_token:
             return {'error': 'Not authenticated'}, 401
         
-        user_data = user_manager.get_user_by_token(auth_token)
+        user_data = _resolve_user(auth_token)
         if not user_data:
             return {'error': 'Invalid or expired session'}, 401
         
@@ -456,7 +537,7 @@ def get_current_user_id():
         return "test-user-id-123"
     
     print(f"🔍 Looking up user by auth_token: {auth_token[:8] if len(auth_token) > 8 else auth_token}...")
-    user_data = user_manager.get_user_by_token(auth_token)
+    user_data = _resolve_user(auth_token)
     if not user_data:
         print(f"❌ No user found for auth_token: {auth_token[:8] if len(auth_token) > 8 else auth_token}...")
         return None
@@ -471,9 +552,8 @@ def get_current_user_id():
 @app.route('/sessions', methods=['GET'])
 def get_sessions():
     """Get all chat sessions for the current user"""
+    user_id = None
     try:
-        print("📋 GET /sessions - Request received")
-        
         # Get current user ID
         user_id = get_current_user_id()
         if not user_id:
@@ -481,7 +561,7 @@ def get_sessions():
         
         # Get sessions for this user only
         sessions = chat_manager.get_all_sessions(user_id)
-        print(f"📋 GET /sessions - Found {len(sessions)} sessions for user {user_id}")
+        log.debug("sessions.list user=%s count=%d", user_id, len(sessions))
         
         response = {
             'sessions': sessions,
@@ -489,77 +569,67 @@ def get_sessions():
         }
         return jsonify(response)
     except Exception as e:
-        print(f"❌ Error getting sessions: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("sessions.list failed for user=%s", user_id)
         return {'error': f'Failed to get sessions: {str(e)}'}, 500
 
 @app.route('/sessions/<session_id>', methods=['GET'])
 def get_session(session_id):
     """Get a specific session with its messages"""
+    user_id = None
     try:
-        print(f"📋 GET /sessions/{session_id} - Request received")
-        print(f"Headers: {request.headers}")
-        print(f"Cookies: {request.cookies}")
-        print(f"Session: {session}")
-        
         # Get auth token from multiple sources
         auth_token = None
+        token_source = None
         
         # 1. Try Authorization header
         auth_header = request.headers.get('Authorization')
         if auth_header and auth_header.startswith('Bearer '):
             auth_token = auth_header[7:]  # Remove 'Bearer ' prefix
-            print(f"Found auth token in header: {auth_token[:8]}...")
+            token_source = 'header'
         
         # 2. Try cookies
         if not auth_token:
             auth_token = request.cookies.get('auth_token')
-            if auth_token:
-                print(f"Found auth token in cookie: {auth_token[:8]}...")
+            token_source = 'cookie'
         
         # 3. Try session
         if not auth_token:
             auth_token = session.get('auth_token')
-            if auth_token:
-                print(f"Found auth token in session: {auth_token[:8]}...")
+            token_source = 'session'
         
         # 4. Try query parameters
         if not auth_token:
             auth_token = request.args.get('auth_token')
-            if auth_token:
-                print(f"Found auth token in query param: {auth_token[:8]}...")
+            token_source = 'query'
+        
+        log.debug("sessions.get session=%s token=%s source=%s",
+                  session_id, _tok_prefix(auth_token), token_source if auth_token else None)
         
         # If we have an auth token, store it in session for future requests
         if auth_token:
             session['auth_token'] = auth_token
-            print(f"✅ Auth token stored in session: {auth_token[:8]}...")
         
         # Get current user ID
-        user_id = None
         if auth_token:
             # For testing purposes
             if auth_token.startswith('test-'):
-                print(f"✅ Using test auth token")
                 user_id = "test-user-id-123"
             else:
-                user_data = user_manager.get_user_by_token(auth_token)
+                user_data = _resolve_user(auth_token)
                 if user_data:
                     user_id = user_data['id']
-                    print(f"✅ Found user: {user_data['username']} (ID: {user_id})")
         
         if not user_id:
-            print("❌ No valid user ID found")
+            log.info("sessions.get session=%s rejected: no valid user", session_id)
             return {'error': 'Authentication required'}, 401
         
         # Get session data, ensuring it belongs to the current user
         session_data = chat_manager.get_session(session_id, user_id)
         if not session_data:
-            print(f"❌ Session {session_id} not found or doesn't belong to user {user_id}")
+            log.info("sessions.get session=%s not found for user=%s", session_id, user_id)
             return {'error': 'Session not found'}, 404
         
         messages = chat_manager.get_session_messages(session_id)
-        print(f"📋 GET /sessions/{session_id} - Found {len(messages)} messages")
         
         response = {
             'session': session_data,
@@ -567,9 +637,7 @@ def get_session(session_id):
         }
         return jsonify(response)
     except Exception as e:
-        print(f"❌ Error getting session {session_id}: {e}")
-        import traceback
-        traceback.print_exc()
+        log.exception("sessions.get failed for session=%s user=%s", session_id, user_id)
         return {'error': f'Failed to get session: {str(e)}'}, 500
 
 @app.route('/sessions', methods=['POST'])
@@ -628,6 +696,7 @@ def delete_session(session_id):
 @app.route('/sessions/<session_id>/messages', methods=['POST'])
 def add_message_to_session(session_id):
     """Add a message to an existing session"""
+    user_id = None
     try:
         # Get auth token from session
         auth_token = session.get('auth_token')
@@ -636,25 +705,21 @@ def add_message_to_session(session_id):
         if not auth_token:
             data = request.get_json(silent=True) or {}
             auth_token = data.get('auth_token')
-            
-        print(f"🔑 Using auth token for message: {auth_token[:8] if auth_token and len(auth_token) > 8 else auth_token}...")
         
         if auth_token:
             session['auth_token'] = auth_token
-            print(f"✅ Auth token stored in session: {auth_token[:8] if len(auth_token) > 8 else auth_token}...")
         
         # Get user from token
         user_data = None
         if auth_token:
-            user_data = user_manager.get_user_by_token(auth_token)
+            user_data = _resolve_user(auth_token)
             
         if not user_data:
             # For testing purposes
             if auth_token and auth_token.startswith('test-'):
-                print(f"✅ Using test auth token")
                 user_id = "test-user-id-123"
             else:
-                print(f"❌ Invalid auth token for session {session_id}")
+                log.info("sessions.add_message session=%s rejected: invalid token=%s", session_id, _tok_prefix(auth_token))
                 return {'error': 'Authentication required'}, 401
         else:
             user_id = user_data['id']
@@ -662,7 +727,7 @@ def add_message_to_session(session_id):
         # Check if session belongs to user
         session_data = chat_manager.get_session(session_id, user_id)
         if not session_data:
-            print(f"❌ Session {session_id} not found or doesn't belong to user {user_id}")
+            log.info("sessions.add_message session=%s not found for user=%s", session_id, user_id)
             return {'error': 'Session not found or access denied'}, 404
             
         data = request.get_json(silent=True) or {}
@@ -675,9 +740,7 @@ def add_message_to_session(session_id):
             'tools_used': data.get('tools_used', [])
         }
         
-        # Debug log
-        print(f"✅ Adding message to session {session_id} for user {user_id}")
-        print(f"Role: {message['role']}, Content: {message['content'][:50]}...")
+        log.debug("sessions.add_message session=%s user=%s role=%s", session_id, user_id, message['role'])
         
         success = chat_manager.add_message(session_id, message)
         if success:
@@ -685,7 +748,7 @@ def add_message_to_session(session_id):
         else:
             return {'error': 'Session not found'}, 404
     except Exception as e:
-        print(f"❌ Error adding message to session {session_id}: {e}")
+        log.exception("sessions.add_message failed for session=%s user=%s", session_id, user_id)
         return {'error': f'Failed to add message: {str(e)}'}, 500
 
 # ------------------------------------------------------------------
@@ -706,20 +769,18 @@ def stats():
 def get_models():
     """Get available models endpoint"""
     try:
-        # Import here to avoid circular imports
-        from ai_core_optimized import llm_manager
-        
         # Get local models
         local_models = []
-        for model_key in llm_manager._ollama_pools.keys():
-            model_config = llm_manager._ollama_pools[model_key]["config"]
-            local_models.append({
-                "id": f"ollama-{model_key}",
-                "name": model_key.capitalize(),
-                "description": f"Local {model_key.capitalize()} model running on Ollama",
-                "strengths": model_config.get("strengths", []),
-                "category": "Local"
-            })
+        if llm_manager is not None:
+            for model_key, pool_data in llm_manager._ollama_pools.items():
+                model_config = pool_data["config"]
+                local_models.append({
+                    "id": f"ollama-{model_key}",
+                    "name": model_key.capitalize(),
+                    "description": f"Local {model_key.capitalize()} model running on Ollama",
+                    "strengths": model_config.get("strengths", []),
+                    "category": "Local"
+                })
         
         # Get Sarvam models
         sarvam_models = [
@@ -733,12 +794,7 @@ def get_models():
         ]
         
         # Get GitHub AI models if available
-        github_models = []
-        try:
-            from ai_core_github_integration import get_github_ai_models
-            github_models = get_github_ai_models()
-        except ImportError:
-            pass
+        github_models = get_github_ai_models() if get_github_ai_models is not None else []
         
         # Combine all models
         all_models = local_models + sarvam_models + github_models
@@ -1,11 +1,75 @@
 """
 MongoDB Chat Session Manager - Handles chat history storage and retrieval with MongoDB
 """
+import copy
+import functools
+import re
 import time
-import uuid
+from datetime import datetime, timezone
 from typing import Dict, List, Any, Optional
+from bson import ObjectId
 from mongodb_manager import get_mongodb
 from pymongo import DESCENDING
+from pymongo.errors import ConnectionFailure
+
+# Conversational openers stripped from the first message when titling a session
+_TITLE_PREFIX_RE = re.compile(
+    r'^(?:how can i|can you|please|i need|help me|what is|explain)\s*', re.IGNORECASE
+)
+
+# Fields returned to the API for a session (_id is included by default)
+SESSION_PROJECTION = {
+    "title": 1,
+    "preview": 1,
+    "created_at": 1,
+    "updated_at": 1,
+    "message_count": 1,
+    "model": 1,
+    "user_id": 1
+}
+
+# Compound index (created by MongoDBManager) that serves message lookups in order
+MESSAGE_SESSION_INDEX = [("session_id", 1), ("timestamp", 1)]
+
+# Fields returned to the API for a message
+MESSAGE_PROJECTION = {
+    "_id": 0,
+    "role": 1,
+    "content": 1,
+    "timestamp": 1,
+    "model": 1,
+    "tools_used": 1
+}
+
+def _requires_mongo(default=None, raise_errors=False):
+    """
+    Run a manager method only when MongoDB is connected.
+    
+    Without a connection, or when the method raises, `default` (copied per
+    call) is returned; with raise_errors the error propagates instead.
+    is_connected() trusts a recent successful ping, so the hot path rarely
+    round-trips; a ConnectionFailure invalidates that ping so the next
+    check pings again.
+    """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if not self.mongodb.is_connected():
+                if raise_errors:
+                    raise Exception("Database connection not available")
+                return copy.copy(default)
+            try:
+                return func(self, *args, **kwargs)
+            except Exception as e:
+                # ConnectionFailure covers AutoReconnect and server selection timeouts
+                if isinstance(e, ConnectionFailure):
+                    self.mongodb.invalidate_ping()
+                print(f"❌ MongoDB error in {func.__name__}: {e}")
+                if raise_errors:
+                    raise
+                return copy.copy(default)
+        return wrapper
+    return decorator
 
 class MongoChatSessionManager:
     """
@@ -13,235 +77,218 @@ class MongoChatSessionManager:
     """
     def __init__(self):
         self.mongodb = get_mongodb()
-        self.sessions_collection = self.mongodb.get_collection("sessions")
-        self.messages_collection = self.mongodb.get_collection("messages")
+        self.sessions_collection = self.mongodb.sessions
+        self.messages_collection = self.mongodb.messages
         
         if not self.mongodb.is_connected():
             print("❌ MongoDB not connected - Chat Session Manager will not work properly")
         else:
             print("✅ MongoDB Chat Session Manager initialized successfully")
     
+    @_requires_mongo([])
     def get_all_sessions(self, user_id: Optional[str] = None) -> List[Dict[str, Any]]:
         """Get all chat sessions sorted by last updated time (newest first)"""
-        if not self.mongodb.is_connected():
-            return []
+        # Build query
+        query = {}
+        if user_id:
+            query["user_id"] = user_id
         
-        try:
-            # Build query
-            query = {}
-            if user_id:
-                query["user_id"] = user_id
-            
-            # Get sessions sorted by updated_at (newest first)
-            sessions_cursor = self.sessions_collection.find(query).sort("updated_at", DESCENDING)
-            
-            sessions_list = []
-            for session_doc in sessions_cursor:
-                # Convert MongoDB document to expected format
-                session_data = {
-                    "id": session_doc["_id"],
-                    "title": session_doc["title"],
-                    "preview": session_doc["preview"],
-                    "timestamp": session_doc["created_at"],
-                    "message_count": session_doc["message_count"],
-                    "model": session_doc.get("model", "unknown"),
-                    "created_at": session_doc["created_at"],
-                    "updated_at": session_doc["updated_at"],
-                    "user_id": session_doc.get("user_id")
-                }
-                sessions_list.append(session_data)
-            
-            return sessions_list
-            
-        except Exception as e:
-            print(f"❌ Error getting sessions: {e}")
-            return []
+        # Get sessions sorted by updated_at (newest first)
+        sessions_cursor = self.sessions_collection.find(
+            query, projection=SESSION_PROJECTION
+        ).sort("updated_at", DESCENDING).batch_size(200)
+        
+        return [self._format_session(session_doc) for session_doc in sessions_cursor]
     
+    @_requires_mongo()
     def get_session(self, session_id: str, user_id: Optional[str] = None) -> Optional[Dict[str, Any]]:
         """Get a specific session by ID"""
-        if not self.mongodb.is_connected():
-            return None
+        # Build query
+        query = {"_id": session_id}
+        if user_id:
+            query["user_id"] = user_id
         
-        try:
-            # Build query
-            query = {"_id": session_id}
-            if user_id:
-                query["user_id"] = user_id
-            
-            session_doc = self.sessions_collection.find_one(query)
-            
-            if not session_doc:
-                return None
-            
-            # Convert to expected format
-            return {
-                "id": session_doc["_id"],
-                "title": session_doc["title"],
-                "preview": session_doc["preview"],
-                "timestamp": session_doc["created_at"],
-                "message_count": session_doc["message_count"],
-                "model": session_doc.get("model", "unknown"),
-                "created_at": session_doc["created_at"],
-                "updated_at": session_doc["updated_at"],
-                "user_id": session_doc.get("user_id")
-            }
-            
-        except Exception as e:
-            print(f"❌ Error getting session {session_id}: {e}")
+        session_doc = self.sessions_collection.find_one(query, projection=SESSION_PROJECTION)
+        
+        if not session_doc:
             return None
+        
+        return self._format_session(session_doc)
+    
+    @staticmethod
+    def _format_session(session_doc: Dict[str, Any]) -> Dict[str, Any]:
+        """Convert a MongoDB session document to the expected API format"""
+        created_at = session_doc["created_at"]
+        return {
+            "id": session_doc["_id"],
+            "title": session_doc["title"],
+            "preview": session_doc["preview"],
+            "timestamp": created_at,
+            "message_count": session_doc["message_count"],
+            "model": session_doc.get("model", "unknown"),
+            "created_at": created_at,
+            "updated_at": session_doc["updated_at"],
+            "user_id": session_doc.get("user_id")
+        }
     
+    @_requires_mongo([])
     def get_session_messages(self, session_id: str) -> List[Dict[str, Any]]:
         """Get all messages for a specific session"""
-        if not self.mongodb.is_connected():
-            return []
+        # Get messages sorted by timestamp (oldest first), in large batches so
+        # long sessions don't pay a getMore per 101 documents. The hint pins
+        # the (session_id, timestamp) index, which already returns documents
+        # in sort order, so the plan never needs an in-memory SORT stage.
+        # Messages of a deleted session linger until the TTL monitor sweeps
+        # them, so expired ones are filtered out - a session recreated
+        # under the same id must not inherit them
+        messages_cursor = self.messages_collection.find(
+            {"session_id": session_id, "expires_at": {"$exists": False}},
+            projection=MESSAGE_PROJECTION
+        ).sort("timestamp", 1).hint(MESSAGE_SESSION_INDEX).batch_size(1000)
         
-        try:
-            # Get messages sorted by timestamp (oldest first)
-            messages_cursor = self.messages_collection.find(
-                {"session_id": session_id}
-            ).sort("timestamp", 1)
-            
-            messages_list = []
-            for message_doc in messages_cursor:
-                # Convert MongoDB document to expected format
-                message_data = {
-                    "role": message_doc["role"],
-                    "content": message_doc["content"],
-                    "timestamp": message_doc["timestamp"],
-                    "model": message_doc.get("model"),
-                    "tools_used": message_doc.get("tools_used", [])
-                }
-                messages_list.append(message_data)
-            
-            return messages_list
-            
-        except Exception as e:
-            print(f"❌ Error getting messages for session {session_id}: {e}")
-            return []
+        return [
+            {
+                "role": message_doc["role"],
+                "content": message_doc["content"],
+                "timestamp": message_doc["timestamp"],
+                "model": message_doc.get("model"),
+                "tools_used": message_doc.get("tools_used", [])
+            }
+            for message_doc in messages_cursor
+        ]
     
+    @_requires_mongo(raise_errors=True)
     def create_session(self, session_id: str, first_message: str, model: str = "ollama-qwen2.5", user_id: Optional[str] = None) -> Dict[str, Any]:
         """Create a new chat session"""
-        if not self.mongodb.is_connected():
-            raise Exception("Database connection not available")
+        timestamp = time.time()
         
-        try:
-            timestamp = time.time()
-            
-            # Generate title from first message
-            title = self._generate_title(first_message)
-            
-            # Create session document
-            session_doc = {
-                "_id": session_id,
-                "title": title,
-                "preview": first_message[:100] + ('...' if len(first_message) > 100 else ''),
-                "created_at": timestamp,
-                "updated_at": timestamp,
-                "message_count": 1,
-                "model": model,
-                "user_id": user_id
-            }
-            
-            # Insert session
-            self.sessions_collection.insert_one(session_doc)
-            
-            # Add first message
-            self.add_message(session_id, {
-                'role': 'user',
-                'content': first_message,
-                'timestamp': timestamp,
-                'model': model
-            })
-            
-            print(f"✅ Created new session: {session_id} for user: {user_id}")
-            
-            # Return session data in expected format
-            return {
-                "id": session_id,
-                "title": title,
-                "preview": session_doc["preview"],
-                "timestamp": timestamp,
-                "message_count": 1,
-                "model": model,
-                "created_at": timestamp,
-                "updated_at": timestamp,
-                "user_id": user_id
-            }
-            
-        except Exception as e:
-            print(f"❌ Error creating session {session_id}: {e}")
-            raise Exception(f"Failed to create session: {str(e)}")
+        # Generate title from first message
+        title = self._generate_title(first_message)
+        
+        # Create session document
+        session_doc = {
+            "_id": session_id,
+            "title": title,
+            "preview": first_message[:100] + ('...' if len(first_message) > 100 else ''),
+            "created_at": timestamp,
+            "updated_at": timestamp,
+            "message_count": 1,
+            "model": model,
+            "user_id": user_id
+        }
+        
+        # Insert session
+        self.sessions_collection.insert_one(session_doc)
+        
+        # Insert the first message directly - session_doc already carries its
+        # count and preview, so add_message's metadata update isn't needed
+        self.messages_collection.insert_one({
+            "_id": ObjectId(),
+            "session_id": session_id,
+            "role": "user",
+            "content": first_message,
+            "timestamp": timestamp,
+            "model": model,
+            "tools_used": []
+        })
+        
+        print(f"✅ Created new session: {session_id} for user: {user_id}")
+        
+        # Return session data in expected format
+        return {
+            "id": session_id,
+            "title": title,
+            "preview": session_doc["preview"],
+            "timestamp": timestamp,
+            "message_count": 1,
+            "model": model,
+            "created_at": timestamp,
+            "updated_at": timestamp,
+            "user_id": user_id
+        }
     
+    @_requires_mongo(False)
     def add_message(self, session_id: str, message: Dict[str, Any]) -> bool:
         """Add a message to a session"""
-        if not self.mongodb.is_connected():
+        timestamp = message.get('timestamp', time.time())
+        
+        # Bump the session metadata atomically; the returned (pre-update)
+        # document doubles as the existence check, supplies the model and
+        # keeps the old preview/updated_at in case the insert below fails
+        update = {
+            "$inc": {"message_count": 1},
+            "$set": {"updated_at": timestamp}
+        }
+        
+        # Update preview if it's a user message
+        if message.get('role', 'user') == 'user':
+            content = message.get('content', '')
+            update["$set"]["preview"] = content[:100] + ('...' if len(content) > 100 else '')
+        
+        session_doc = self.sessions_collection.find_one_and_update(
+            {"_id": session_id},
+            update,
+            projection={"model": 1, "preview": 1, "updated_at": 1}
+        )
+        if not session_doc:
+            print(f"❌ Session {session_id} not found")
             return False
         
+        # Normalize message data
+        normalized_message = {
+            "_id": ObjectId(),  # time-ordered, so inserts append to the right of the _id index
+            "session_id": session_id,
+            "role": message.get('role', 'user'),
+            "content": message.get('content', ''),
+            "timestamp": timestamp,
+            "model": message.get('model', session_doc.get('model', 'unknown')),
+            "tools_used": message.get('tools_used', [])
+        }
+        
+        # Insert message
         try:
-            # Check if session exists
-            session_doc = self.sessions_collection.find_one({"_id": session_id})
-            if not session_doc:
-                print(f"❌ Session {session_id} not found")
-                return False
-            
-            # Normalize message data
-            normalized_message = {
-                "_id": str(uuid.uuid4()),
-                "session_id": session_id,
-                "role": message.get('role', 'user'),
-                "content": message.get('content', ''),
-                "timestamp": message.get('timestamp', time.time()),
-                "model": message.get('model', session_doc.get('model', 'unknown')),
-                "tools_used": message.get('tools_used', [])
-            }
-            
-            # Insert message
             self.messages_collection.insert_one(normalized_message)
-            
-            # Update session metadata
-            update_data = {
-                "message_count": session_doc["message_count"] + 1,
-                "updated_at": normalized_message["timestamp"]
-            }
-            
-            # Update preview if it's a user message
-            if normalized_message['role'] == 'user':
-                content = normalized_message['content']
-                update_data['preview'] = content[:100] + ('...' if len(content) > 100 else '')
-            
-            self.sessions_collection.update_one(
-                {"_id": session_id},
-                {"$set": update_data}
-            )
-            
-            return True
-            
+        except Exception:
+            self._undo_message_bump(session_id, session_doc, update)
+            raise
+        
+        return True
+    
+    def _undo_message_bump(self, session_id: str, session_doc: Dict[str, Any], update: Dict[str, Any]):
+        """Take a message that failed to insert back out of its session's metadata"""
+        try:
+            self.sessions_collection.update_one({"_id": session_id}, {"$inc": {"message_count": -1}})
+            # Restore the old preview/updated_at unless a newer message replaced them
+            restore = {field: session_doc[field] for field in update["$set"] if field in session_doc}
+            if restore:
+                self.sessions_collection.update_one(
+                    {"_id": session_id, "updated_at": update["$set"]["updated_at"]},
+                    {"$set": restore}
+                )
         except Exception as e:
-            print(f"❌ Error adding message to session {session_id}: {e}")
-            return False
+            print(f"❌ Could not roll back message count for session {session_id}: {e}")
     
+    @_requires_mongo(False)
     def delete_session(self, session_id: str) -> bool:
         """Delete a chat session and all its messages"""
-        if not self.mongodb.is_connected():
-            return False
+        # Delete the session; once it's gone its messages are unreachable
+        session_result = self.sessions_collection.delete_one({"_id": session_id})
         
-        try:
-            # Delete all messages for this session
-            messages_result = self.messages_collection.delete_many({"session_id": session_id})
-            
-            # Delete the session
-            session_result = self.sessions_collection.delete_one({"_id": session_id})
-            
-            if session_result.deleted_count > 0:
-                print(f"✅ Deleted session {session_id} and {messages_result.deleted_count} messages")
-                return True
-            else:
-                print(f"❌ Session {session_id} not found")
-                return False
-                
-        except Exception as e:
-            print(f"❌ Error deleting session {session_id}: {e}")
+        if session_result.deleted_count == 0:
+            print(f"❌ Session {session_id} not found")
             return False
+        
+        # Expire the messages instead of deleting them inline - the TTL
+        # index on expires_at removes them in the background (readers
+        # skip messages that carry expires_at)
+        messages_result = self.messages_collection.update_many(
+            {"session_id": session_id, "expires_at": {"$exists": False}},
+            {"$set": {"expires_at": datetime.now(timezone.utc)}},
+            hint=MESSAGE_SESSION_INDEX
+        )
+        
+        print(f"✅ Deleted session {session_id}; {messages_result.modified_count} messages scheduled for removal")
+        return True
     
     def _generate_title(self, message: str) -> str:
         """Generate a title from the first message"""
@@ -254,41 +301,31 @@ class MongoChatSessionManager:
             title = title[:47] + "..."
         
         # Remove common prefixes
-        prefixes = ["how can i", "can you", "please", "i need", "help me", "what is", "explain"]
-        title_lower = title.lower()
-        for prefix in prefixes:
-            if title_lower.startswith(prefix):
-                title = title[len(prefix):].strip()
-                break
+        title = _TITLE_PREFIX_RE.sub('', title, count=1)
         
         # Capitalize first letter
-        if title:
-            title = title[0].upper() + title[1:]
+        title = title[:1].upper() + title[1:]
         
         return title or "New Chat"
     
+    @_requires_mongo({"error": "Database not connected"})
     def get_session_stats(self) -> Dict[str, Any]:
         """Get session statistics"""
-        if not self.mongodb.is_connected():
-            return {"error": "Database not connected"}
+        # Unfiltered totals come from collection metadata, no scan
+        total_sessions = self.sessions_collection.estimated_document_count()
+        total_messages = self.messages_collection.estimated_document_count()
         
-        try:
-            total_sessions = self.sessions_collection.count_documents({})
-            total_messages = self.messages_collection.count_documents({})
-            
-            # Get sessions by model
-            pipeline = [
-                {"$group": {"_id": "$model", "count": {"$sum": 1}}},
-                {"$sort": {"count": -1}}
-            ]
-            model_stats = list(self.sessions_collection.aggregate(pipeline))
-            
-            return {
-                "total_sessions": total_sessions,
-                "total_messages": total_messages,
-                "sessions_by_model": model_stats
-            }
-            
-        except Exception as e:
-            print(f"❌ Error getting session stats: {e}")
-            return {"error": str(e)}
\ No newline at end of file
+        # Get sessions by model; the leading $sort lets the planner walk the
+        # model index so the $group only reads index keys
+        pipeline = [
+            {"$sort": {"model": 1}},
+            {"$group": {"_id": "$model", "count": {"$sum": 1}}},
+            {"$sort": {"count": -1}}
+        ]
+        model_stats = list(self.sessions_collection.aggregate(pipeline, allowDiskUse=False))
+        
+        return {
+            "total_sessions": total_sessions,
+            "total_messages": total_messages,
+            "sessions_by_model": model_stats
+        }
\ No newline at end of file
@@ -3,19 +3,27 @@ GitHub AI Models Integration - Provides access to GitHub AI models via Azure AI
 """
 import os
 import time
+import logging
 import threading
+from array import array
+from collections import deque
 from typing import Dict, List, Any, Optional
-from dataclasses import dataclass
+from dataclasses import dataclass, field
 from dotenv import load_dotenv
 
 # Load environment variables first
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # Import Azure AI Inference SDK
 try:
     from azure.ai.inference import ChatCompletionsClient
     from azure.ai.inference.models import SystemMessage, UserMessage, ToolMessage
     from azure.core.credentials import AzureKeyCredential
+    from azure.core.pipeline.transport import RequestsTransport
+    import requests
+    from requests.adapters import HTTPAdapter
     AZURE_SDK_AVAILABLE = True
 except ImportError:
     print("⚠️ Azure AI Inference SDK not available. GitHub AI models will not work.")
@@ -78,79 +86,259 @@ GITHUB_AI_MODELS = {
     }
 }
 
+TOOL_INSTRUCTIONS_SUFFIX = "\n\nYou have access to various tools. When appropriate, use these tools to provide better answers. Always mention which tool you're using in your response."
+
+def _with_tool_instructions(system_prompt: str) -> str:
+    """Append tool instructions to a system prompt that doesn't mention tools"""
+    if "tool" in system_prompt.lower():
+        return system_prompt
+    return system_prompt + TOOL_INSTRUCTIONS_SUFFIX
+
+# Model system prompts are constant, so their tool-enhanced form is computed once
+for _model_config in GITHUB_AI_MODELS.values():
+    _model_config["system_prompt_enhanced"] = _with_tool_instructions(_model_config["system_prompt"])
+
+# GITHUB_AI_MODELS is constant, so the public model listing is built once at import
+_AVAILABLE_MODELS = tuple(
+    {
+        "id": model_id,
+        "name": config["model_id"],
+        "description": config["description"],
+        "context_window": config["context_window"],
+        "strengths": config["strengths"]
+    }
+    for model_id, config in GITHUB_AI_MODELS.items()
+)
+
+# Per-token rate limits (GitHub allows ~5000 requests/hour per token)
+TOKEN_BUCKET_CAPACITY = 5000
+TOKEN_BUCKET_REFILL_RATE = 5000 / 3600  # tokens per second
+
+@dataclass
+class TokenBucket:
+    """Token bucket tracking the remaining request budget for one GitHub token"""
+    capacity: float
+    rate: float
+    tokens: float
+    last_refill: float
+    lock: threading.Lock = field(default_factory=threading.Lock, repr=False)
+    
+    def available(self, now: float) -> float:
+        """Estimate available requests at `now` without mutating the bucket"""
+        return min(self.capacity, self.tokens + max(0.0, now - self.last_refill) * self.rate)
+    
+    def refill(self, now: float):
+        """Lazily refill the bucket up to `now` (caller holds `lock`)"""
+        if now > self.last_refill:
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+
+# Longest a request waits for a rate-limited token before giving up
+TOKEN_MAX_WAIT = 5.0  # seconds
+
+# Sliding window applied on top of the buckets so each token's emission rate
+# stays smooth across the hour instead of bursting at window boundaries
+RATE_WINDOW_SECONDS = 3600
+RATE_WINDOW_SEGMENTS = 60  # one segment per minute
+
+class SlidingWindowCounter:
+    """Sliding-window-counter rate limiter built from fixed time segments.
+    
+    The window spans `segments` full segments plus the partially expired
+    oldest one, whose count is weighted by the fraction still inside the
+    window. Not thread-safe - callers hold the owning bucket's lock.
+    """
+    
+    def __init__(self, limit: float, window: float = RATE_WINDOW_SECONDS,
+                 segments: int = RATE_WINDOW_SEGMENTS, now: Optional[float] = None):
+        self.limit = limit
+        self.segment_length = window / segments
+        self.segments = deque([0] * (segments + 1), maxlen=segments + 1)
+        self.current_segment = int((time.monotonic() if now is None else now) // self.segment_length)
+        self.total = 0
+    
+    def _advance(self, now: float):
+        """Rotate in empty segments up to the one containing `now`"""
+        segment = int(now // self.segment_length)
+        steps = min(segment - self.current_segment, self.segments.maxlen)
+        for _ in range(steps):
+            self.total -= self.segments[0]
+            self.segments.append(0)  # deque drops the oldest segment
+        if segment > self.current_segment:
+            self.current_segment = segment
+    
+    def weighted_count(self, now: float) -> float:
+        """Approximate number of requests in the window ending at `now`"""
+        self._advance(now)
+        offset = (now % self.segment_length) / self.segment_length
+        return self.total - self.segments[0] * offset
+    
+    def try_acquire(self, now: float) -> bool:
+        """Record a request if the window has room for it"""
+        if self.weighted_count(now) + 1 > self.limit:
+            return False
+        self.segments[-1] += 1
+        self.total += 1
+        return True
+    
+    def time_until_available(self, now: float) -> float:
+        """Seconds until the next segment boundary if the window is full"""
+        if self.weighted_count(now) + 1 <= self.limit:
+            return 0.0
+        return self.segment_length - (now % self.segment_length)
+
 class GitHubAITokenManager:
     """Manages GitHub API tokens with rate limiting awareness"""
     
-    def __init__(self, tokens: List[str]):
+    def __init__(self, tokens: List[str], capacity: float = TOKEN_BUCKET_CAPACITY,
+                 rate: float = TOKEN_BUCKET_REFILL_RATE):
         # Filter out empty or invalid tokens (GitHub tokens should be 40 chars)
         self.tokens = [token for token in tokens if token and len(token) >= 30]
-        self.current_index = 0
-        self.token_usage = {token: {"last_used": 0, "count": 0} for token in self.tokens}
-        self._lock = threading.RLock()
+        now = time.monotonic()
+        self.buckets = [TokenBucket(capacity, rate, capacity, now) for _ in self.tokens]
+        self.windows = [SlidingWindowCounter(rate * RATE_WINDOW_SECONDS) for _ in self.tokens]
+        # Usage stats as packed per-token arrays: monotonic last-use time and a
+        # 64-bit request count, both written under the owning bucket's lock
+        self._last_used = array('d', [0.0] * len(self.tokens))
+        self._counts = array('Q', [0] * len(self.tokens))
         
         if not self.tokens:
-            print("⚠️ No valid GitHub tokens provided. GitHub AI models will not work.")
-            print("Please check your .env file and ensure GITHUB_TOKEN and GITHUB_TOKEN2 are set correctly.")
-            print(f"Found tokens: {tokens}")
+            logger.warning("No valid GitHub tokens provided (%d candidates) - GitHub AI models will not work. "
+                           "Check that GITHUB_TOKEN and GITHUB_TOKEN2 are set correctly in .env", len(tokens))
         else:
-            print(f"✅ Found {len(self.tokens)} valid GitHub tokens for AI models")
+            logger.info("Found %d valid GitHub tokens for AI models", len(self.tokens))
     
-    def get_token(self) -> Optional[str]:
-        """Get the next available token with rate limiting awareness"""
+    def get_token(self, max_wait: float = TOKEN_MAX_WAIT) -> Optional[str]:
+        """Get the token with the most remaining budget
+        
+        If all are exhausted, waits up to `max_wait` seconds for one to free
+        up; returns None when none will within that time.
+        """
         if not self.tokens:
             return None
+        
+        deadline = time.monotonic() + max_wait
+        while True:
+            # Try buckets in order of headroom (unlocked estimate), claiming a
+            # request under that bucket's own lock if both limiters admit it
+            now = time.monotonic()
+            order = sorted(range(len(self.buckets)), key=lambda i: self.buckets[i].available(now),
+                           reverse=True)
             
-        with self._lock:
-            # Simple round-robin for now
-            token = self.tokens[self.current_index]
-            self.current_index = (self.current_index + 1) % len(self.tokens)
-            
-            # Update usage stats
-            self.token_usage[token]["last_used"] = time.time()
-            self.token_usage[token]["count"] += 1
+            for index in order:
+                bucket = self.buckets[index]
+                with bucket.lock:
+                    now = time.monotonic()
+                    bucket.refill(now)
+                    if bucket.tokens >= 1 and self.windows[index].try_acquire(now):
+                        bucket.tokens -= 1
+                        
+                        # Update usage stats
+                        self._last_used[index] = now
+                        self._counts[index] += 1
+                        
+                        return self.tokens[index]
             
-            return token
+            # Every token is limited - sleep until the soonest one admits a
+            # request, unless that is past the deadline
+            waits = []
+            for bucket, window in zip(self.buckets, self.windows):
+                with bucket.lock:
+                    now = time.monotonic()
+                    waits.append(max((1 - bucket.available(now)) / bucket.rate,
+                                     window.time_until_available(now)))
+            wait = max(min(waits), 0.01)
+            if time.monotonic() + wait > deadline:
+                logger.warning("All GitHub tokens are rate limited; the next frees up in %.1fs", min(waits))
+                return None
+            time.sleep(wait)
+    
+    @property
+    def token_usage(self) -> Dict[str, Dict[str, float]]:
+        """Snapshot of per-token usage (`last_used` is on the monotonic clock)"""
+        return {
+            token: {"last_used": self._last_used[i], "count": self._counts[i]}
+            for i, token in enumerate(self.tokens)
+        }
 
 # Initialize token manager
 token_manager = GitHubAITokenManager(GITHUB_TOKENS)
 
+# HTTP connection pool sizing for the inference endpoint
+HTTP_POOL_CONNECTIONS = 20
+HTTP_POOL_MAXSIZE = 50
+
+def _build_transport() -> "RequestsTransport":
+    """Build a keep-alive transport with a large connection pool.
+    
+    urllib3 pools hand out connections LIFO, so the most recently used
+    (still warm) socket is reused first and TLS handshakes are avoided.
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(
+        pool_connections=HTTP_POOL_CONNECTIONS,
+        pool_maxsize=HTTP_POOL_MAXSIZE,
+        pool_block=False
+    )
+    session.mount("https://", adapter)
+    return RequestsTransport(session=session, session_owner=True)
+
+# Chat role -> Azure SDK message constructor
+_ROLE_DISPATCH = {
+    "system": SystemMessage,
+    "user": UserMessage,
+    # This is simplified - in a real implementation you'd handle tool calls
+    "assistant": lambda content: ToolMessage(content=content, tool_call_id="none"),
+} if AZURE_SDK_AVAILABLE else {}
+
 class GitHubAIClient:
     """Client for GitHub AI models using Azure AI Inference SDK"""
     
     def __init__(self):
         self.clients = {}
-        self._lock = threading.RLock()
+        # Only guards client creation - lookups read the dict without locking
+        self._create_lock = threading.Lock()
     
     def get_client(self) -> Optional[ChatCompletionsClient]:
         """Get or create a client with the current token"""
         if not AZURE_SDK_AVAILABLE:
-            print("❌ Azure SDK not available - please install azure-ai-inference package")
+            logger.error("Azure SDK not available - please install azure-ai-inference package")
             return None
             
         token = token_manager.get_token()
         if not token:
-            print("❌ No valid GitHub token available")
+            logger.error("No valid GitHub token available")
             return None
             
         # Validate token format (GitHub tokens are 40 chars)
         if len(token) < 30:
-            print(f"❌ GitHub token appears invalid (length: {len(token)})")
+            logger.error("GitHub token appears invalid (length: %d)", len(token))
             return None
             
-        with self._lock:
-            if token not in self.clients:
+        # Fast path: clients are created once per token, so this is read-mostly
+        client = self.clients.get(token)
+        if client is not None:
+            return client
+        
+        with self._create_lock:
+            # Double-check - another thread may have created it while we waited
+            client = self.clients.get(token)
+            if client is None:
                 try:
-                    print(f"Creating new GitHub AI client with token: {token[:5]}...{token[-5:]}")
-                    self.clients[token] = ChatCompletionsClient(
+                    if logger.isEnabledFor(logging.DEBUG):
+                        logger.debug("Creating new GitHub AI client with token: %s...%s", token[:5], token[-5:])
+                    client = ChatCompletionsClient(
                         endpoint=GITHUB_AI_ENDPOINT,
-                        credential=AzureKeyCredential(token)
+                        credential=AzureKeyCredential(token),
+                        transport=_build_transport()
                     )
-                    print("✅ Successfully created GitHub AI client")
+                    self.clients[token] = client
+                    logger.debug("Successfully created GitHub AI client")
                 except Exception as e:
-                    print(f"❌ Error creating GitHub AI client: {e}")
+                    logger.error("Error creating GitHub AI client: %s", e)
                     return None
             
-            return self.clients[token]
+            return client
     
     def complete(self, messages: List[Dict[str, str]], model_id: str, temperature: float = 0.7) -> Optional[Dict]:
         """Complete a conversation using GitHub AI models"""
@@ -161,19 +349,13 @@ class GitHubAIClient:
             }
         
         try:
-            # Convert messages to Azure SDK format
-            azure_messages = []
-            for msg in messages:
-                role = msg.get("role", "user")
-                content = msg.get("content", "")
-                
-                if role == "system":
-                    azure_messages.append(SystemMessage(content))
-                elif role == "user":
-                    azure_messages.append(UserMessage(content))
-                elif role == "assistant":
-                    # This is simplified - in a real implementation you'd handle tool calls
-                    azure_messages.append(ToolMessage(content=content, tool_call_id="none"))
+            # Convert messages to Azure SDK format (unknown roles are dropped)
+            dispatch = _ROLE_DISPATCH
+            azure_messages = [
+                dispatch[role](msg.get("content", ""))
+                for msg in messages
+                if (role := msg.get("role", "user")) in dispatch
+            ]
             
             # Make the API call
             response = client.complete(
@@ -199,33 +381,24 @@ github_ai_client = GitHubAIClient()
 
 def get_available_models() -> List[Dict]:
     """Get list of available GitHub AI models"""
-    models = []
-    for model_id, config in GITHUB_AI_MODELS.items():
-        models.append({
-            "id": model_id,
-            "name": config["model_id"],
-            "description": config["description"],
-            "context_window": config["context_window"],
-            "strengths": config["strengths"]
-        })
-    return models
+    return list(_AVAILABLE_MODELS)
 
 def github_ai_complete(user_input: str, model_id: str, system_prompt: Optional[str] = None) -> Dict:
     """Complete a conversation using GitHub AI models with tool support"""
     # Get the actual model ID from our config
     if model_id in GITHUB_AI_MODELS:
-        actual_model_id = GITHUB_AI_MODELS[model_id]["model_id"]
-        if not system_prompt:
-            system_prompt = GITHUB_AI_MODELS[model_id]["system_prompt"]
+        model_config = GITHUB_AI_MODELS[model_id]
+        actual_model_id = model_config["model_id"]
+        if system_prompt:
+            # Caller-supplied prompts still need the tool instructions check
+            system_prompt = _with_tool_instructions(system_prompt)
+        else:
+            system_prompt = model_config["system_prompt_enhanced"]
     else:
         return {
             "error": f"Unknown model ID: {model_id}"
         }
     
-    # Enhance system prompt with tool instructions
-    if system_prompt and "tool" not in system_prompt.lower():
-        system_prompt += "\n\nYou have access to various tools. When appropriate, use these tools to provide better answers. Always mention which tool you're using in your response."
-    
     # Create messages
     messages = []
     
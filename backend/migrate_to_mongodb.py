@@ -4,10 +4,34 @@ Migration script to transfer data from JSON files to MongoDB
 import json
 import os
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timezone
 from pathlib import Path
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError, DuplicateKeyError
 from user_manager_mongodb import MongoUserManager
 from chat_session_manager_mongodb import MongoChatSessionManager
-from mongodb_manager import get_mongodb
+from mongodb_manager import get_mongodb, POOL_OPTIONS
+from sequential_thinking_mongodb import get_sequential_thinking_manager
+
+# orjson parses chat text several times faster than the stdlib; both accept bytes
+try:
+    import orjson
+    _json_loads = orjson.loads
+except ImportError:
+    _json_loads = json.loads
+
+# Batch sizes for bulk inserts during migration
+USER_BATCH_SIZE = 500
+MESSAGE_BATCH_SIZE = 1000
+
+DUPLICATE_KEY_ERROR = 11000
+
+READ_BUFFER_SIZE = 1 << 20  # 1 MiB reads for the JSON/JSONL source files
+
+# Session files migrated concurrently; defaults to half the connection pool so
+# workers don't queue on it (raise MONGODB_MAX_POOL_SIZE to run more)
+MIGRATION_WORKERS = int(os.getenv("MIGRATION_WORKERS", str(max(1, POOL_OPTIONS["maxPoolSize"] // 2))))
 
 def migrate_users():
     """Migrate users from JSON files to MongoDB"""
@@ -21,73 +45,192 @@ def migrate_users():
     mongo_user_manager = MongoUserManager()
     migrated_count = 0
     
+    # Users are upserted in batches with $setOnInsert: an existing _id is left
+    # untouched, and a username/email clash is rejected by the unique
+    # (case-insensitive) indexes instead of a per-user lookup
+    ops = []
+    pending = []  # (username, token_docs) per queued op
+    
+    def flush_users():
+        nonlocal migrated_count
+        if not ops:
+            return
+        
+        # Buffers are cleared however the flush ends, so a failed batch is
+        # never resubmitted with the next one
+        try:
+            conflicts = set()
+            try:
+                result = mongo_user_manager.users_collection.bulk_write(ops, ordered=False)
+                upserted = result.upserted_ids
+            except BulkWriteError as e:
+                upserted = {u["index"]: u["_id"] for u in e.details.get("upserted", [])}
+                conflicts = {error["index"] for error in e.details.get("writeErrors", [])}
+            
+            for index, (username, _) in enumerate(pending):
+                if index in upserted:
+                    print(f"✅ Migrated user: {username} (ID: {upserted[index]})")
+                elif index in conflicts:
+                    print(f"👤 User {username} conflicts with an existing user in MongoDB, skipping")
+                else:
+                    print(f"👤 User {username} already exists in MongoDB, skipping")
+            migrated_count += len(upserted)
+            
+            # Auth tokens only for users that were actually inserted
+            token_docs = [doc for index in upserted for doc in pending[index][1]]
+            if token_docs:
+                try:
+                    mongo_user_manager.tokens_collection.insert_many(token_docs, ordered=False)
+                except BulkWriteError as e:
+                    failed = len(e.details.get("writeErrors", []))
+                    print(f"⚠️ {failed} of {len(token_docs)} session tokens could not be migrated")
+        finally:
+            ops.clear()
+            pending.clear()
+    
     # Load sessions.json if it exists
     sessions_file = users_dir / "sessions.json"
     sessions_data = {}
     if sessions_file.exists():
         try:
-            with open(sessions_file, 'r', encoding='utf-8') as f:
-                sessions_data = json.load(f)
+            with open(sessions_file, 'rb', buffering=READ_BUFFER_SIZE) as f:
+                sessions_data = _json_loads(f.read())
             print(f"📋 Loaded {len(sessions_data)} session tokens")
         except Exception as e:
             print(f"⚠️ Could not load sessions.json: {e}")
     
+    # Group auth tokens by user once instead of scanning sessions_data per user
+    token_created_at = datetime.now(timezone.utc)
+    tokens_by_user = {}
+    for token, user_id in sessions_data.items():
+        tokens_by_user.setdefault(user_id, []).append(
+            {"_id": token, "user_id": user_id, "created_at": token_created_at}
+        )
+    now = time.time()
+    
     # Migrate each user file
     for user_file in users_dir.glob("*.json"):
         if user_file.name == "sessions.json":
             continue
             
         try:
-            with open(user_file, 'r', encoding='utf-8') as f:
-                user_data = json.load(f)
+            with open(user_file, 'rb', buffering=READ_BUFFER_SIZE) as f:
+                user_data = _json_loads(f.read())
             
             # Check if user has required fields
             if not all(field in user_data for field in ['id', 'username', 'email', 'password_hash']):
                 print(f"⚠️ Skipping invalid user file: {user_file.name}")
                 continue
             
-            # Check if user already exists in MongoDB
-            existing_user = mongo_user_manager.users_collection.find_one({
-                "$or": [
-                    {"_id": user_data['id']},
-                    {"username": {"$regex": f"^{user_data['username']}$", "$options": "i"}}
-                ]
-            })
-            
-            if existing_user:
-                print(f"👤 User {user_data['username']} already exists in MongoDB, skipping")
-                continue
-            
-            # Create user document for MongoDB
+            # Create user document for MongoDB (_id comes from the upsert filter)
             user_doc = {
-                "_id": user_data['id'],
                 "username": user_data['username'],
                 "email": user_data['email'],
                 "password_hash": user_data['password_hash'],
-                "created_at": user_data.get('created_at', time.time()),
-                "last_login": user_data.get('last_login', time.time()),
-                "auth_tokens": []
+                "created_at": user_data.get('created_at', now),
+                "last_login": user_data.get('last_login', now)
             }
             
-            # Add auth tokens if they exist in sessions_data
-            for token, user_id in sessions_data.items():
-                if user_id == user_data['id']:
-                    user_doc["auth_tokens"].append({
-                        "token": token,
-                        "created_at": time.time()
-                    })
-            
-            # Insert user into MongoDB
-            mongo_user_manager.users_collection.insert_one(user_doc)
-            migrated_count += 1
-            
-            print(f"✅ Migrated user: {user_data['username']} (ID: {user_data['id']})")
+            ops.append(UpdateOne({"_id": user_data['id']}, {"$setOnInsert": user_doc}, upsert=True))
+            pending.append((user_data['username'], tokens_by_user.get(user_data['id'], [])))
+            if len(ops) >= USER_BATCH_SIZE:
+                flush_users()
             
         except Exception as e:
             print(f"❌ Error migrating user file {user_file.name}: {e}")
     
+    try:
+        flush_users()
+    except Exception as e:
+        print(f"❌ Error flushing final user batch: {e}")
+    
     print(f"🎉 User migration completed! Migrated {migrated_count} users")
 
+def _insert_messages(messages_collection, msg_buf) -> int:
+    """Insert a batch of messages; returns how many were inserted
+    
+    Message _ids are deterministic, so on a rerun the copies already in
+    MongoDB are rejected as duplicates and skipped.
+    """
+    try:
+        return len(messages_collection.insert_many(msg_buf, ordered=False).inserted_ids)
+    except BulkWriteError as e:
+        if any(error.get("code") != DUPLICATE_KEY_ERROR for error in e.details.get("writeErrors", [])):
+            raise
+        return e.details.get("nInserted", 0)
+
+def _migrate_one_session(session_file: Path, sessions_collection, messages_collection):
+    """Migrate one session and its messages; returns (migrated, message_count)
+    
+    Messages go in first and the session document last, so a session only
+    exists in MongoDB once all of its messages do. A run that fails part way
+    leaves no session document, and the next run picks the session up again.
+    """
+    with open(session_file, 'rb', buffering=READ_BUFFER_SIZE) as f:
+        session_data = _json_loads(f.read())
+    
+    session_id = session_data.get('id', session_file.stem)
+    
+    # Check if session already exists
+    existing_session = sessions_collection.find_one({"_id": session_id}, projection={"_id": 1})
+    if existing_session:
+        print(f"💬 Session {session_id} already exists in MongoDB, skipping")
+        return False, 0
+    
+    # Create session document for MongoDB
+    session_doc = {
+        "_id": session_id,
+        "title": session_data.get('title', 'Migrated Chat'),
+        "preview": session_data.get('preview', ''),
+        "created_at": session_data.get('created_at', time.time()),
+        "updated_at": session_data.get('updated_at', time.time()),
+        "message_count": session_data.get('message_count', 0),
+        "model": session_data.get('model', 'unknown'),
+        "user_id": session_data.get('user_id')
+    }
+    
+    # Migrate messages for this session (errors propagate, so the session
+    # document isn't written for a partial set of messages)
+    migrated_messages = 0
+    messages_file = session_file.parent / f"{session_id}_messages.jsonl"
+    if messages_file.exists():
+        msg_buf = []
+        with open(messages_file, 'rb', buffering=READ_BUFFER_SIZE) as f:
+            for line in f:
+                if line.strip():
+                    try:
+                        message_data = _json_loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    
+                    timestamp = message_data.get('timestamp', time.time())
+                    
+                    # Create message document for MongoDB
+                    msg_buf.append({
+                        "_id": f"{session_id}_{int(timestamp * 1000)}",
+                        "session_id": session_id,
+                        "role": message_data.get('role', 'user'),
+                        "content": message_data.get('content', ''),
+                        "timestamp": timestamp,
+                        "model": message_data.get('model', session_doc['model']),
+                        "tools_used": message_data.get('tools_used', [])
+                    })
+                    if len(msg_buf) >= MESSAGE_BATCH_SIZE:
+                        migrated_messages += _insert_messages(messages_collection, msg_buf)
+                        msg_buf = []
+        
+        if msg_buf:
+            migrated_messages += _insert_messages(messages_collection, msg_buf)
+    
+    try:
+        sessions_collection.insert_one(session_doc)
+    except DuplicateKeyError:
+        print(f"💬 Session {session_id} was migrated concurrently, skipping")
+        return False, migrated_messages
+    
+    print(f"✅ Migrated session: {session_id} ({session_doc['title']})")
+    return True, migrated_messages
+
 def migrate_chat_sessions():
     """Migrate chat sessions from JSON files to MongoDB"""
     print("🔄 Starting chat session migration...")
@@ -101,77 +244,42 @@ def migrate_chat_sessions():
     migrated_sessions = 0
     migrated_messages = 0
     
-    # Migrate each session file
-    for session_file in chat_history_dir.glob("*.json"):
-        if session_file.name.endswith("_messages.jsonl"):
-            continue  # Skip message files, we'll handle them separately
-            
-        try:
-            with open(session_file, 'r', encoding='utf-8') as f:
-                session_data = json.load(f)
-            
-            session_id = session_data.get('id', session_file.stem)
-            
-            # Check if session already exists
-            existing_session = mongo_session_manager.sessions_collection.find_one({"_id": session_id})
-            if existing_session:
-                print(f"💬 Session {session_id} already exists in MongoDB, skipping")
+    # Writes are acknowledged, so the totals below count only documents
+    # MongoDB actually stored
+    sessions_collection = mongo_session_manager.sessions_collection
+    messages_collection = mongo_session_manager.messages_collection
+    
+    # Session files are independent, so workers migrate them concurrently over
+    # the shared MongoClient pool
+    session_files = [
+        session_file for session_file in chat_history_dir.glob("*.json")
+        if not session_file.name.endswith("_messages.jsonl")
+    ]
+    with ThreadPoolExecutor(max_workers=MIGRATION_WORKERS, thread_name_prefix="migrate") as executor:
+        futures = {
+            executor.submit(_migrate_one_session, session_file, sessions_collection, messages_collection): session_file
+            for session_file in session_files
+        }
+        
+        for future in as_completed(futures):
+            try:
+                migrated, message_count = future.result()
+            except Exception as e:
+                print(f"❌ Error migrating session file {futures[future].name}: {e}")
                 continue
             
-            # Create session document for MongoDB
-            session_doc = {
-                "_id": session_id,
-                "title": session_data.get('title', 'Migrated Chat'),
-                "preview": session_data.get('preview', ''),
-                "created_at": session_data.get('created_at', time.time()),
-                "updated_at": session_data.get('updated_at', time.time()),
-                "message_count": session_data.get('message_count', 0),
-                "model": session_data.get('model', 'unknown'),
-                "user_id": session_data.get('user_id')
-            }
-            
-            # Insert session into MongoDB
-            mongo_session_manager.sessions_collection.insert_one(session_doc)
-            migrated_sessions += 1
-            
-            # Migrate messages for this session
-            messages_file = chat_history_dir / f"{session_id}_messages.jsonl"
-            if messages_file.exists():
-                try:
-                    with open(messages_file, 'r', encoding='utf-8') as f:
-                        for line in f:
-                            if line.strip():
-                                try:
-                                    message_data = json.loads(line)
-                                    
-                                    # Create message document for MongoDB
-                                    message_doc = {
-                                        "_id": f"{session_id}_{int(message_data.get('timestamp', time.time()) * 1000)}",
-                                        "session_id": session_id,
-                                        "role": message_data.get('role', 'user'),
-                                        "content": message_data.get('content', ''),
-                                        "timestamp": message_data.get('timestamp', time.time()),
-                                        "model": message_data.get('model', session_doc['model']),
-                                        "tools_used": message_data.get('tools_used', [])
-                                    }
-                                    
-                                    # Insert message into MongoDB
-                                    mongo_session_manager.messages_collection.insert_one(message_doc)
-                                    migrated_messages += 1
-                                    
-                                except json.JSONDecodeError:
-                                    continue
-                                    
-                except Exception as e:
-                    print(f"⚠️ Error migrating messages for session {session_id}: {e}")
-            
-            print(f"✅ Migrated session: {session_id} ({session_doc['title']})")
-            
-        except Exception as e:
-            print(f"❌ Error migrating session file {session_file.name}: {e}")
+            migrated_sessions += migrated
+            migrated_messages += message_count
     
     print(f"🎉 Chat session migration completed! Migrated {migrated_sessions} sessions and {migrated_messages} messages")
 
+def migrate_sequential_thinking():
+    """Move sequential thinking sessions from the legacy collection into buckets"""
+    print("🔄 Starting sequential thinking migration...")
+    
+    migrated = get_sequential_thinking_manager().migrate_legacy_sessions()
+    print(f"🎉 Sequential thinking migration completed! Migrated {migrated} sessions")
+
 def verify_migration():
     """Verify the migration was successful"""
     print("🔍 Verifying migration...")
@@ -227,6 +335,8 @@ def main():
     print("-" * 30)
     migrate_chat_sessions()
     print("-" * 30)
+    migrate_sequential_thinking()
+    print("-" * 30)
     verify_migration()
     
     print("=" * 50)
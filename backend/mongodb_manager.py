@@ -4,23 +4,66 @@ MongoDB Manager - Handles MongoDB connections and operations with proper SSL set
 import os
 import time
 import ssl
+import threading
 from typing import Dict, List, Any, Optional
-from pymongo import MongoClient
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import bson
+import pymongo
+from pymongo import MongoClient, IndexModel, ASCENDING, DESCENDING
+from pymongo.write_concern import WriteConcern
 from pymongo.errors import ConnectionFailure, ServerSelectionTimeoutError
 from dotenv import load_dotenv
 import logging
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
+# Wire compression for every connection strategy. pymongo skips (with a
+# warning) any compressor whose library isn't installed, so zlib is always
+# available as the last resort.
+WIRE_COMPRESSION = {
+    "compressors": "zstd,snappy,zlib",
+    "zlibCompressionLevel": 3
+}
+
+# Connection pool settings for the single process-wide MongoClient that every
+# manager shares through get_mongodb(). Bulk workloads (e.g. a parallel
+# migration) can raise the limits through the environment.
+POOL_OPTIONS = {
+    "maxPoolSize": int(os.getenv("MONGODB_MAX_POOL_SIZE", "20")),
+    "minPoolSize": int(os.getenv("MONGODB_MIN_POOL_SIZE", "2")),
+    "waitQueueTimeoutMS": 2000,
+    "retryWrites": True
+}
+
+# Write concern for non-critical, high-frequency writes (last_login bumps,
+# auth tokens, thought saves): acknowledged by the primary without waiting
+# for the journal flush
+FAST_WRITE_CONCERN = WriteConcern(w=1, j=False)
+
+# The pure-Python BSON codec and wire protocol are several times slower than
+# the C extensions; warn rather than fail so a source install still runs
+if not (bson.has_c() and pymongo.has_c()):
+    logger.warning("pymongo C extensions not available (bson: %s, pymongo: %s) - "
+                   "BSON encoding will be slow. Reinstall pymongo[zstd] from a "
+                   "binary wheel to enable them.", bson.has_c(), pymongo.has_c())
+
 class MongoDBManager:
     """MongoDB connection and operations manager"""
     
     def __init__(self):
         self.client = None
         self.db = None
+        # Core collection handles, bound once per connection
+        self.users = None
+        self.sessions = None
+        self.messages = None
         self.connected = False
         self._connection_attempts = 0
         self._max_attempts = 3
+        self._last_ping = 0.0
+        self._ping_ttl = 5.0  # seconds a successful ping is trusted for
         self._initialize_connection()
     
     def _initialize_connection(self):
@@ -51,9 +94,7 @@ class MongoDBManager:
                     "serverSelectionTimeoutMS": 45000,  # 45 seconds
                     "connectTimeoutMS": 90000,          # 90 seconds  
                     "socketTimeoutMS": 90000,           # 90 seconds
-                    "retryWrites": True,
-                    "maxPoolSize": 10,
-                    "minPoolSize": 1
+                    "retryWrites": True
                 }
             },
             {
@@ -66,22 +107,39 @@ class MongoDBManager:
             }
         ]
         
-        for strategy in connection_strategies:
-            try:
-                print(f"🔄 Trying {strategy['name']}...")
-                
-                self.client = MongoClient(mongodb_uri, **strategy['config'])
+        # Race all strategies concurrently; the first successful ping wins, so a
+        # dead server fails in max(timeouts) rather than sum(timeouts)
+        executor = ThreadPoolExecutor(max_workers=len(connection_strategies),
+                                      thread_name_prefix="mongo-connect")
+        try:
+            futures = {
+                executor.submit(self._try_strategy, mongodb_uri, strategy): strategy
+                for strategy in connection_strategies
+            }
+            
+            for future in as_completed(futures):
+                strategy = futures[future]
+                try:
+                    client = future.result()
+                except Exception as e:
+                    print(f"❌ {strategy['name']} failed: {e}")
+                    continue
                 
-                # Test the connection with a ping
-                result = self.client.admin.command('ping')
-                print(f"✅ Ping successful: {result}")
+                # Close the losing clients as their attempts finish
+                for other in futures:
+                    if other is not future:
+                        other.add_done_callback(self._close_strategy_client)
                 
-                # Get database
+                self.client = client
                 self.db = self.client[database_name]
+                self.users = self.db.users
+                self.sessions = self.db.sessions
+                self.messages = self.db.messages
                 self.connected = True
                 
                 print(f"✅ Successfully connected to MongoDB database: {database_name}")
                 print(f"✅ Using strategy: {strategy['name']}")
+                logger.info("MongoDB topology: %s", self.client.topology_description)
                 
                 # Create indexes for better performance
                 self._create_indexes()
@@ -94,22 +152,40 @@ class MongoDBManager:
                     print(f"⚠️ Warning: Could not list collections: {e}")
                 
                 return  # Success! Exit the function
-                
-            except Exception as e:
-                print(f"❌ {strategy['name']} failed: {e}")
-                if self.client:
-                    try:
-                        self.client.close()
-                    except:
-                        pass
-                    self.client = None
-                self.connected = False
-                continue
+        finally:
+            # Don't wait for slower strategies still inside their timeouts
+            executor.shutdown(wait=False, cancel_futures=True)
         
         # All strategies failed
         print("❌ All MongoDB connection strategies failed")
         self.connected = False
     
+    @staticmethod
+    def _try_strategy(mongodb_uri: str, strategy: Dict[str, Any]) -> MongoClient:
+        """Connect with a single strategy and verify it with a ping"""
+        print(f"🔄 Trying {strategy['name']}...")
+        client = MongoClient(mongodb_uri, **{**WIRE_COMPRESSION, **POOL_OPTIONS, **strategy['config']})
+        try:
+            result = client.admin.command('ping')
+            print(f"✅ Ping successful: {result}")
+            return client
+        except Exception:
+            try:
+                client.close()
+            except:
+                pass
+            raise
+    
+    @staticmethod
+    def _close_strategy_client(future):
+        """Close the client of a strategy that lost the connection race"""
+        if future.cancelled() or future.exception() is not None:
+            return
+        try:
+            future.result().close()
+        except:
+            pass
+    
     def _create_indexes(self):
         """Create database indexes for better performance"""
         try:
@@ -119,32 +195,46 @@ class MongoDBManager:
             
             print("🔧 Creating MongoDB indexes...")
             
-            # Users collection indexes
-            users_collection = self.db.users
-            try:
-                users_collection.create_index("username", unique=True)
-                users_collection.create_index("email", unique=True)
-                users_collection.create_index("auth_tokens.token")
-                print("✅ Users collection indexes created")
-            except Exception as e:
-                print(f"⚠️ Warning: Could not create users indexes: {e}")
+            # Each collection's indexes are sent in a single createIndexes
+            # command and built in the background so startup doesn't block writes
+            
+            # Users collection indexes are owned by MongoUserManager (case-insensitive collation)
             
             # Sessions collection indexes
-            sessions_collection = self.db.sessions
+            sessions_collection = self.sessions
             try:
-                sessions_collection.create_index("user_id")
-                sessions_collection.create_index("created_at")
-                sessions_collection.create_index([("user_id", 1), ("created_at", -1)])
+                # (user_id, updated_at desc) backs get_all_sessions' match + sort;
+                # its user_id prefix also serves plain user_id equality lookups
+                sessions_collection.create_indexes([
+                    IndexModel("created_at", background=True),
+                    IndexModel("model", background=True),
+                    IndexModel([("user_id", ASCENDING), ("created_at", DESCENDING)], background=True),
+                    IndexModel([("user_id", ASCENDING), ("updated_at", DESCENDING)],
+                               name="user_updated_desc", background=True),
+                ])
                 print("✅ Sessions collection indexes created")
             except Exception as e:
                 print(f"⚠️ Warning: Could not create sessions indexes: {e}")
             
+            # The standalone user_id index is redundant with the compound prefixes
+            try:
+                if "user_id_1" in sessions_collection.index_information():
+                    sessions_collection.drop_index("user_id_1")
+            except Exception as e:
+                print(f"⚠️ Warning: Could not drop redundant user_id index: {e}")
+            
             # Messages collection indexes
-            messages_collection = self.db.messages
+            messages_collection = self.messages
             try:
-                messages_collection.create_index("session_id")
-                messages_collection.create_index("timestamp")
-                messages_collection.create_index([("session_id", 1), ("timestamp", 1)])
+                messages_collection.create_indexes([
+                    IndexModel("session_id", background=True),
+                    IndexModel("timestamp", background=True),
+                    IndexModel([("session_id", ASCENDING), ("timestamp", ASCENDING)], background=True),
+                    # Messages of deleted sessions are stamped with expires_at and
+                    # swept by the TTL monitor; live messages stay out of the index
+                    IndexModel("expires_at", expireAfterSeconds=0, sparse=True,
+                               name="message_expiry_ttl", background=True),
+                ])
                 print("✅ Messages collection indexes created")
             except Exception as e:
                 print(f"⚠️ Warning: Could not create messages indexes: {e}")
@@ -154,39 +244,51 @@ class MongoDBManager:
         except Exception as e:
             print(f"⚠️ Warning: Could not create indexes: {e}")
     
-    def get_collection(self, collection_name: str):
-        """Get a MongoDB collection"""
+    def get_collection(self, collection_name: str, *, fast: bool = False):
+        """Get a MongoDB collection (with FAST_WRITE_CONCERN when `fast` is set)"""
         if not self.connected or self.db is None:
-            print(f"⚠️ Warning: Cannot get collection '{collection_name}' - not connected to MongoDB")
+            logger.warning("Cannot get collection '%s' - not connected to MongoDB", collection_name)
             return None
         
         try:
-            collection = self.db[collection_name]
-            # Test the collection by attempting a simple operation
-            collection.find_one()
-            return collection
+            # No probe query here - pymongo's pool detects dead sockets itself
+            if fast:
+                return self.db.get_collection(collection_name, write_concern=FAST_WRITE_CONCERN)
+            return self.db[collection_name]
         except Exception as e:
-            print(f"❌ Error accessing collection '{collection_name}': {e}")
+            logger.error("Error accessing collection '%s': %s", collection_name, e)
             return None
     
     def is_connected(self) -> bool:
         """Check if MongoDB is connected with a live ping test"""
         if not self.connected or self.client is None:
             return False
+        
+        # Trust a recent successful ping instead of a round trip per call
+        if time.monotonic() - self._last_ping < self._ping_ttl:
+            return True
             
         try:
             # Test the connection with a ping (with timeout)
             result = self.client.admin.command('ping', maxTimeMS=5000)  # 5 second timeout
-            return result.get('ok') == 1
+            if result.get('ok') == 1:
+                self._last_ping = time.monotonic()
+                return True
+            return False
         except Exception as e:
-            print(f"❌ MongoDB connection test failed: {e}")
+            logger.error("MongoDB connection test failed: %s", e)
             self.connected = False
             return False
     
+    def invalidate_ping(self):
+        """Forget the cached ping after a network error so the next check re-pings"""
+        self._last_ping = 0.0
+    
     def reconnect(self):
         """Attempt to reconnect to MongoDB"""
         print("🔄 Attempting to reconnect to MongoDB...")
         self.connected = False
+        self._last_ping = 0.0
         if self.client:
             try:
                 self.client.close()
@@ -212,7 +314,15 @@ class MongoDBManager:
                 self.client = None
                 self.connected = False
     
-    def test_connection(self) -> Dict[str, Any]:
+    def liveness(self) -> Dict[str, Any]:
+        """Cheap server probe via the `hello` command"""
+        return self.client.admin.command("hello")
+    
+    def list_collections(self) -> List[str]:
+        """List collection names (a full catalog scan - call only when needed)"""
+        return self.db.list_collection_names()
+    
+    def test_connection(self, include_collections: bool = False) -> Dict[str, Any]:
         """Test MongoDB connection and return status"""
         if not self.is_connected():
             return {
@@ -223,11 +333,12 @@ class MongoDBManager:
         
         try:
             # Test database operations
-            collections = self.db.list_collection_names()
+            hello = self.liveness()
             server_info = self.client.server_info()
+            collections = self.list_collections() if include_collections else []
             
             return {
-                "connected": True,
+                "connected": bool(hello.get("ok")),
                 "database": self.db.name,
                 "collections": collections,
                 "server_version": server_info.get("version", "unknown"),
@@ -242,21 +353,34 @@ class MongoDBManager:
 
 # Global MongoDB manager instance with lazy initialization
 _mongodb_manager = None
+_mongodb_lock = threading.Lock()
 
 def get_mongodb():
-    """Get MongoDB manager instance (singleton pattern)"""
+    """Get MongoDB manager instance (thread-safe singleton, built on first use)"""
     global _mongodb_manager
     if _mongodb_manager is None:
-        _mongodb_manager = MongoDBManager()
+        with _mongodb_lock:
+            if _mongodb_manager is None:
+                _mongodb_manager = MongoDBManager()
     return _mongodb_manager
 
+def _reset_after_fork():
+    """Drop the parent's manager in a forked child so each worker opens its own client"""
+    global _mongodb_manager, _mongodb_lock
+    _mongodb_manager = None
+    _mongodb_lock = threading.Lock()  # the parent may have held it mid-fork
+
+# MongoClient isn't fork-safe; pre-fork servers must not share the parent's sockets
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
 def test_mongodb_connection():
     """Test MongoDB connection and print results"""
     print("🧪 Testing MongoDB Connection")
     print("=" * 50)
     
     mongodb = get_mongodb()
-    status = mongodb.test_connection()
+    status = mongodb.test_connection(include_collections=True)
     
     if status["connected"]:
         print("✅ MongoDB Connection Test Passed")
@@ -267,15 +391,4 @@ def test_mongodb_connection():
         print("❌ MongoDB Connection Test Failed")
         print(f"Error: {status['error']}")
     
-    return status["connected"]
-
-# Initialize on import (but don't fail if it doesn't work)
-try:
-    mongodb_manager = get_mongodb()
-    if mongodb_manager.is_connected():
-        print("✅ MongoDB manager initialized successfully")
-    else:
-        print("⚠️ MongoDB manager initialized but not connected")
-except Exception as e:
-    print(f"⚠️ MongoDB manager initialization error: {e}")
-    mongodb_manager = None
\ No newline at end of file
+    return status["connected"]
\ No newline at end of file
@@ -2,34 +2,121 @@
 
 import asyncio
 import functools
+import os
+import pickle
 import time
 from typing import Dict, Any, Optional
-from flask import Flask
+from flask import Flask, Response
 from flask_caching import Cache
+from flask_caching.backends.base import BaseCache
 import redis
 import threading
+from collections import OrderedDict, deque
 from concurrent.futures import ThreadPoolExecutor
 
 # ------------------------------------------------------------------
 # 1. CACHING LAYER
 # ------------------------------------------------------------------
 
-# Redis cache for production (fallback to simple cache for development)
-try:
-    cache_config = {
-        'CACHE_TYPE': 'RedisCache',
-        'CACHE_REDIS_URL': 'redis://localhost:6379/0',
-        'CACHE_DEFAULT_TIMEOUT': 300  # 5 minutes
-    }
-except:
-    cache_config = {
-        'CACHE_TYPE': 'SimpleCache',
-        'CACHE_DEFAULT_TIMEOUT': 300
-    }
+# Redis cache for production (fallback to an in-process cache for development).
+# Which one is used is decided in setup_cache once Redis has been probed.
+REDIS_CACHE_URL = os.environ.get('CACHE_REDIS_URL', 'redis://localhost:6379/0')
+
+redis_cache_config = {
+    'CACHE_TYPE': 'RedisCache',
+    'CACHE_REDIS_URL': REDIS_CACHE_URL,
+    'CACHE_DEFAULT_TIMEOUT': 300  # 5 minutes
+}
+
+local_cache_config = {
+    'CACHE_TYPE': 'performance_improvements.ByteBoundedTTLCache',
+    'CACHE_DEFAULT_TIMEOUT': 300,
+    'CACHE_MAX_BYTES': 64 * 1024 * 1024  # 64 MB
+}
+
+class ByteBoundedTTLCache(BaseCache):
+    """In-process LRU cache with per-entry TTL, bounded by total pickled value size"""
+    
+    def __init__(self, default_timeout=300, max_bytes=64 * 1024 * 1024):
+        super().__init__(default_timeout=default_timeout)
+        self.max_bytes = max_bytes
+        self._entries = OrderedDict()  # key -> (expires_at, payload), least recent first
+        self._size = 0
+        self._lock = threading.Lock()
+    
+    @classmethod
+    def factory(cls, app, config, args, kwargs):
+        kwargs["max_bytes"] = config.get("CACHE_MAX_BYTES", 64 * 1024 * 1024)
+        return cls(*args, **kwargs)
+    
+    def _expires_at(self, timeout):
+        if timeout is None:
+            timeout = self.default_timeout
+        return time.monotonic() + timeout if timeout > 0 else 0  # 0 = never expires
+    
+    def _remove(self, key):
+        entry = self._entries.pop(key, None)
+        if entry is not None:
+            self._size -= len(entry[1])
+        return entry is not None
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            expires_at, payload = entry
+            if expires_at and expires_at <= time.monotonic():
+                self._remove(key)
+                return None
+            self._entries.move_to_end(key)
+        return pickle.loads(payload)
+    
+    def set(self, key, value, timeout=None):
+        payload = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        if len(payload) > self.max_bytes:
+            return False
+        
+        with self._lock:
+            self._remove(key)
+            self._entries[key] = (self._expires_at(timeout), payload)
+            self._size += len(payload)
+            
+            # Evict least recently used entries until we fit the byte budget
+            while self._size > self.max_bytes:
+                _, (_, evicted) = self._entries.popitem(last=False)
+                self._size -= len(evicted)
+        return True
+    
+    def add(self, key, value, timeout=None):
+        if self.has(key):
+            return False
+        return self.set(key, value, timeout)
+    
+    def delete(self, key):
+        with self._lock:
+            return self._remove(key)
+    
+    def has(self, key):
+        return self.get(key) is not None
+    
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._size = 0
+        return True
 
 def setup_cache(app: Flask):
-    """Setup caching for the Flask app"""
-    cache = Cache(app)
+    """Setup caching for the Flask app, using Redis only if it is reachable"""
+    try:
+        redis.Redis.from_url(REDIS_CACHE_URL, socket_connect_timeout=0.2).ping()
+        cache_config = redis_cache_config
+        print("✅ Using Redis cache")
+    except redis.exceptions.RedisError as e:
+        cache_config = local_cache_config
+        print(f"⚠️ Redis unavailable ({e}), using in-process cache")
+    
+    cache = Cache()
     app.config.update(cache_config)
     cache.init_app(app)
     return cache
@@ -42,47 +129,56 @@ class OptimizedLLMManager:
     """Optimized LLM with connection pooling and caching"""
     
     def __init__(self):
-        self.llm_pool = []
         self.pool_size = 3  # Multiple LLM instances
+        # Slots are filled lazily so processes that never call the LLM don't
+        # pay for the clients
+        self.llm_pool = [None] * self.pool_size
         self.current_index = 0
-        self._initialize_pool()
     
-    def _initialize_pool(self):
-        """Initialize multiple LLM instances for concurrent processing"""
+    def _create_llm(self):
+        """Create a single LLM instance"""
         from langchain_ollama import ChatOllama
         
-        for _ in range(self.pool_size):
-            llm = ChatOllama(
-                model="qwen2.5:7b-instruct-q5_K_M", 
-                temperature=0.2,
-                # Optimization parameters
-                num_ctx=4096,  # Context window
-                num_predict=1024,  # Max tokens to predict
-                repeat_penalty=1.1,
-                top_k=40,
-                top_p=0.9,
-            )
-            self.llm_pool.append(llm)
+        return ChatOllama(
+            model="qwen2.5:7b-instruct-q5_K_M", 
+            temperature=0.2,
+            # Optimization parameters
+            num_ctx=4096,  # Context window
+            num_predict=1024,  # Max tokens to predict
+            repeat_penalty=1.1,
+            top_k=40,
+            top_p=0.9,
+        )
     
     def get_llm(self):
         """Get next available LLM instance (round-robin)"""
-        llm = self.llm_pool[self.current_index]
-        self.current_index = (self.current_index + 1) % self.pool_size
+        index = self.current_index
+        self.current_index = (index + 1) % self.pool_size
+        
+        llm = self.llm_pool[index]
+        if llm is None:
+            llm = self.llm_pool[index] = self._create_llm()
         return llm
 
 # ------------------------------------------------------------------
 # 3. ASYNC TOOL EXECUTION
 # ------------------------------------------------------------------
 
+# Shared pool for all tool managers - tool calls are IO-bound, so size it at 2x CPUs
+_TOOL_EXECUTOR = ThreadPoolExecutor(
+    max_workers=min(32, (os.cpu_count() or 4) * 2),
+    thread_name_prefix="tool"
+)
+
 class AsyncToolManager:
     """Execute multiple tools concurrently"""
     
-    def __init__(self, max_workers=5):
-        self.executor = ThreadPoolExecutor(max_workers=max_workers)
+    def __init__(self, executor: Optional[ThreadPoolExecutor] = None):
+        self.executor = executor or _TOOL_EXECUTOR
     
     async def execute_tools_parallel(self, tool_calls):
         """Execute multiple tools in parallel"""
-        loop = asyncio.get_event_loop()
+        loop = asyncio.get_running_loop()
         tasks = []
         
         for tool_call in tool_calls:
@@ -105,14 +201,23 @@ class AsyncToolManager:
 # 4. RESPONSE STREAMING
 # ------------------------------------------------------------------
 
+_SSE_PREFIX = b"data: "
+_SSE_SUFFIX = b"\n\n"
+
 def stream_response(generator):
-    """Stream responses for real-time updates"""
+    """Stream responses for real-time updates (yields pre-encoded SSE frames)"""
     def generate():
         for chunk in generator:
-            yield f"data: {chunk}\n\n"
+            if not isinstance(chunk, bytes):
+                chunk = str(chunk).encode("utf-8")
+            yield _SSE_PREFIX + chunk + _SSE_SUFFIX
     
     return generate()
 
+def sse_response(generator) -> Response:
+    """Wrap a chunk generator in a server-sent events response"""
+    return Response(stream_response(generator), mimetype="text/event-stream", direct_passthrough=True)
+
 # ------------------------------------------------------------------
 # 5. MEMORY OPTIMIZATION
 # ------------------------------------------------------------------
@@ -122,23 +227,23 @@ class OptimizedMemoryManager:
     
     def __init__(self, max_memory_size=1000):
         self.max_memory_size = max_memory_size
-        self.memory_cache = {}
+        self.memory_cache = OrderedDict()  # ordered least -> most recently used
     
     def get_optimized_memory(self, thread_id: str):
         """Get memory with size limits and compression"""
-        if thread_id not in self.memory_cache:
+        memory = self.memory_cache.get(thread_id)
+        if memory is None:
             from langgraph.checkpoint.memory import MemorySaver
-            self.memory_cache[thread_id] = MemorySaver()
+            memory = self.memory_cache[thread_id] = MemorySaver()
+        else:
+            self.memory_cache.move_to_end(thread_id)
         
-        return self.memory_cache[thread_id]
+        return memory
     
     def cleanup_old_memories(self):
-        """Clean up old conversation memories"""
-        if len(self.memory_cache) > self.max_memory_size:
-            # Remove oldest 20% of memories
-            oldest_keys = list(self.memory_cache.keys())[:len(self.memory_cache)//5]
-            for key in oldest_keys:
-                del self.memory_cache[key]
+        """Evict least recently used conversation memories beyond the size limit"""
+        while len(self.memory_cache) > self.max_memory_size:
+            self.memory_cache.popitem(last=False)
 
 # ------------------------------------------------------------------
 # 6. DATABASE CONNECTION POOLING
@@ -162,25 +267,42 @@ class RequestBatcher:
     def __init__(self, batch_size=5, timeout=0.1):
         self.batch_size = batch_size
         self.timeout = timeout
-        self.pending_requests = []
-        self.batch_timer = None
+        self.pending_requests = deque()
+        self._lock = threading.Lock()
+        self._flush_event = threading.Event()
+        self._stopped = False
+        # One long-lived drain thread instead of a Timer thread per batch
+        self._worker = threading.Thread(target=self._drain_loop, name="request-batcher", daemon=True)
+        self._worker.start()
     
     def add_request(self, request):
         """Add request to batch"""
-        self.pending_requests.append(request)
+        with self._lock:
+            self.pending_requests.append(request)
+            batch_full = len(self.pending_requests) >= self.batch_size
         
-        if len(self.pending_requests) >= self.batch_size:
+        if batch_full:
+            self._flush_event.set()
+    
+    def stop(self):
+        """Stop the drain thread after flushing any pending requests"""
+        self._stopped = True
+        self._flush_event.set()
+        self._worker.join()
+        self._process_batch()
+    
+    def _drain_loop(self):
+        """Flush every `timeout` seconds, or as soon as a batch fills up"""
+        while not self._stopped:
+            self._flush_event.wait(self.timeout)
+            self._flush_event.clear()
             self._process_batch()
-        elif self.batch_timer is None:
-            self.batch_timer = threading.Timer(self.timeout, self._process_batch)
-            self.batch_timer.start()
     
     def _process_batch(self):
         """Process accumulated batch"""
-        if self.pending_requests:
-            # Process batch here
-            self.pending_requests.clear()
+        with self._lock:
+            batch = [self.pending_requests.popleft() for _ in range(len(self.pending_requests))]
         
-        if self.batch_timer:
-            self.batch_timer.cancel()
-            self.batch_timer = None
\ No newline at end of file
+        if batch:
+            # Process batch here
+            pass
@@ -1,127 +1,402 @@
 """
 Sequential Thinking MongoDB Manager - Handles sequential thinking storage in MongoDB
 """
+import copy
+import functools
+import itertools
+from collections import OrderedDict
+import threading
 import time
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Tuple
+from pymongo import ASCENDING, DESCENDING, DeleteMany, ReplaceOne
+from pymongo.errors import ConnectionFailure, DuplicateKeyError, PyMongoError
 from mongodb_manager import get_mongodb
 
+# Thoughts are stored in buckets of BUCKET_SIZE consecutive steps per session:
+#   {"_id": ObjectId, "session_id": str, "bucket": int, "nsamples": int,
+#    "thoughts": [...], "updated_at": float}
+# Thought `step` lives in bucket step // BUCKET_SIZE, so a whole tool session
+# (MAX_DEPTH = 100) is one document and one index entry, while larger sessions
+# still can't grow into the 16 MB document cap
+BUCKET_SIZE = 100
+# Pre-bucket layout, one {"session_id", "thoughts": [...]} document per session.
+# Sessions still there are moved into buckets the first time they are read
+LEGACY_COLLECTION_NAME = "sequential_thinking"
+THOUGHT_FIELDS = ("step", "text", "timestamp", "uuid", "semantic_id", "confidence",
+                  "depth", "parent")  # parent is set on branched thoughts only
+THOUGHT_PROJECTION = {"_id": 0, **{f"thoughts.{field}": 1 for field in THOUGHT_FIELDS}}
+SESSIONS_CACHE_TTL = 5.0  # seconds get_all_sessions results are reused
+READ_CACHE_SIZE = 1024    # cached load_thoughts / get_session_stats results
+READ_CACHE_TTL = 60.0     # seconds; writes through this manager invalidate sooner
+VERSION_TRACK_SIZE = 4096 # sessions whose write versions are remembered
+
+def _mongo_op(default=None, log=True):
+    """
+    Run a manager method against the cached collection.
+    
+    Returns `default` when MongoDB is unavailable or the driver raises a
+    PyMongoError; only connection failures drop the cached handle.
+    DuplicateKeyError and non-driver exceptions propagate. `default` may be a
+    callable taking the method's arguments; other values are copied per call.
+    """
+    def decorator(func):
+        def fallback(args, kwargs):
+            return default(*args, **kwargs) if callable(default) else copy.copy(default)
+        
+        @functools.wraps(func)
+        def wrapper(self, *args, **kwargs):
+            if self.get_collection() is None:
+                # Silently fail if MongoDB not available - fallback will handle it
+                return fallback(args, kwargs)
+            try:
+                return func(self, *args, **kwargs)
+            except DuplicateKeyError:
+                raise
+            except PyMongoError as e:
+                # ConnectionFailure covers AutoReconnect and server selection timeouts
+                if isinstance(e, ConnectionFailure):
+                    self._reconnect()
+                if log:
+                    print(f"❌ MongoDB error in {func.__name__}: {e}")
+                return fallback(args, kwargs)
+        return wrapper
+    return decorator
+
 class SequentialThinkingManager:
     """MongoDB-based sequential thinking manager"""
     
     def __init__(self):
         self.mongodb = get_mongodb()
-        self.collection_name = "sequential_thinking"
+        self.collection_name = "sequential_thought_buckets"
+        self._session_hint = None  # index name passed as `hint` once it exists
+        self._collection = self._resolve_collection()
+        self._sessions_cache = (0.0, [])  # (monotonic timestamp, session ids)
+        # Read cache keyed by (kind, session_id, version, ...); a write bumps the
+        # session's version so older entries are never hit again and age out.
+        # Versions come from one counter so a value is never reused
+        self._versions = OrderedDict()  # session_id -> version, least recent first
+        self._version_counter = itertools.count(1)
+        self._read_cache = OrderedDict()  # key -> (expires_at, value), least recent first
+        self._cache_lock = threading.Lock()
+        self._ensure_indexes()
     
-    def get_collection(self):
-        """Get the sequential thinking collection"""
+    def _ensure_indexes(self):
+        """Create the (session_id, bucket) index used by every lookup"""
+        collection = self.get_collection()
+        if collection is None:
+            return
+        
+        try:
+            self._session_hint = collection.create_index(
+                [("session_id", ASCENDING), ("bucket", ASCENDING)],
+                unique=True, background=True, name="session_bucket_unique"
+            )
+        except Exception as e:
+            print(f"⚠️ Warning: Could not create sequential_thinking index: {e}")
+    
+    def _resolve_collection(self):
+        """Look up the collection handle if MongoDB is connected"""
         if not self.mongodb.is_connected():
             return None
-        return self.mongodb.get_collection(self.collection_name)
+        # Thought saves are frequent and recoverable from the file backup
+        return self.mongodb.get_collection(self.collection_name, fast=True)
     
-    def load_thoughts(self, session_id: str) -> List[Dict[str, Any]]:
-        """Load thoughts for a session from MongoDB"""
-        try:
-            collection = self.get_collection()
-            if not collection:
-                return []
-            
-            # Find the session document
-            session_doc = collection.find_one({"session_id": session_id})
-            if not session_doc:
-                return []
-            
-            # Return the thoughts, sorted by step
-            thoughts = session_doc.get("thoughts", [])
-            return sorted(thoughts, key=lambda x: x.get("step", 0))
-            
-        except Exception as e:
-            return []
+    def _reconnect(self):
+        """Drop the cached handle after a driver error so the next call rebinds it"""
+        self._collection = None
+    
+    def _bump_version(self, session_id: str):
+        """Invalidate cached reads for a session
+        
+        Writers bump before and after the write: the first bump stops hits on
+        older reads, the second orphans anything a concurrent read cached
+        from pre-write data while the write was in flight.
+        """
+        with self._cache_lock:
+            self._versions[session_id] = next(self._version_counter)
+            self._versions.move_to_end(session_id)
+            while len(self._versions) > VERSION_TRACK_SIZE:
+                self._purge_cached(self._versions.popitem(last=False)[0])
+    
+    def _forget_session(self, session_id: str):
+        """Drop a session's version and cached reads (after it is deleted)"""
+        with self._cache_lock:
+            self._versions.pop(session_id, None)
+            self._purge_cached(session_id)
+    
+    def _purge_cached(self, session_id: str):
+        """Remove a session's read-cache entries (caller holds the cache lock)
+        
+        Needed whenever a version is dropped: the session falls back to
+        version 0, which must not match entries cached before.
+        """
+        for key in [key for key in self._read_cache if key[1] == session_id]:
+            del self._read_cache[key]
+    
+    def _cache_key(self, kind: str, session_id: str, *extra) -> Tuple:
+        """Build a read-cache key tied to the session's current version"""
+        return (kind, session_id, self._versions.get(session_id, 0), *extra)
+    
+    def _cache_get(self, key: Tuple):
+        """Return a cached value (or None) if it hasn't expired"""
+        with self._cache_lock:
+            entry = self._read_cache.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._read_cache[key]
+                return None
+            self._read_cache.move_to_end(key)
+            return entry[1]
+    
+    def _cache_set(self, key: Tuple, value):
+        """Store a value, evicting the least recently used entries past the cap"""
+        with self._cache_lock:
+            self._read_cache[key] = (time.monotonic() + READ_CACHE_TTL, value)
+            self._read_cache.move_to_end(key)
+            while len(self._read_cache) > READ_CACHE_SIZE:
+                self._read_cache.popitem(last=False)
+    
+    def _legacy_collection(self):
+        """The pre-bucket collection, or None when not connected"""
+        if not self.mongodb.is_connected():
+            return None
+        return self.mongodb.get_collection(LEGACY_COLLECTION_NAME)
+    
+    def _migrate_legacy_session(self, session_id: str) -> bool:
+        """Move one session from the legacy collection into buckets; False if it has none"""
+        legacy = self._legacy_collection()
+        if legacy is None:
+            return False
+        doc = legacy.find_one({"session_id": session_id}, {"_id": 0, "thoughts": 1})
+        if not doc:
+            return False
+        
+        thoughts = sorted(doc.get("thoughts", []), key=lambda thought: thought.get("step", 0))
+        if [thought.get("step") for thought in thoughts] != list(range(len(thoughts))):
+            # Buckets need steps 0..n-1; keep the stored order and say so
+            print(f"⚠️ Renumbering legacy thoughts of session {session_id} with missing or gapped steps")
+            thoughts = [{**thought, "step": step} for step, thought in enumerate(thoughts)]
+        self._bump_version(session_id)
+        self._collection.bulk_write(self._flush_to_buckets(session_id, thoughts, time.time()),
+                                    ordered=False)
+        self._bump_version(session_id)
+        # Only removed once the buckets are written, so a failure can be retried
+        legacy.delete_one({"session_id": session_id})
+        self._sessions_cache = (0.0, [])
+        return True
+    
+    @_mongo_op(default=0)
+    def migrate_legacy_sessions(self) -> int:
+        """One-off: move every session left in the legacy collection into buckets"""
+        legacy = self._legacy_collection()
+        if legacy is None:
+            return 0
+        return sum(self._migrate_legacy_session(session_id)
+                   for session_id in legacy.distinct("session_id"))
+    
+    def get_collection(self):
+        """Get the sequential thinking collection (cached after the first lookup)"""
+        if self._collection is None:
+            self._collection = self._resolve_collection()
+        return self._collection
+    
+    @_mongo_op(default=[], log=False)
+    def load_thoughts(self, session_id: str, limit: Optional[int] = None) -> List[Dict[str, Any]]:
+        """Load thoughts (or only the last `limit` thoughts) for a session from MongoDB"""
+        key = self._cache_key("thoughts", session_id, limit)
+        thoughts = self._cache_get(key)
+        if thoughts is None:
+            cursor = self._collection.find({"session_id": session_id}, THOUGHT_PROJECTION,
+                                           hint=self._session_hint)
+            if limit:
+                # Walk buckets newest first until `limit` thoughts are covered
+                buckets = []
+                count = 0
+                for doc in cursor.sort("bucket", DESCENDING):
+                    buckets.append(doc.get("thoughts", []))
+                    count += len(buckets[-1])
+                    if count >= limit:
+                        break
+                thoughts = [thought for bucket in reversed(buckets) for thought in bucket][-limit:]
+            else:
+                thoughts = [
+                    thought
+                    for doc in cursor.sort("bucket", ASCENDING)
+                    for thought in doc.get("thoughts", [])
+                ]
+            if not thoughts and self._migrate_legacy_session(session_id):
+                return self.load_thoughts(session_id, limit)
+            self._cache_set(key, thoughts)
+        
+        # Callers mutate the thoughts they load, so hand out copies
+        return [dict(thought) for thought in thoughts]
+    
+    def save_thoughts(self, session_id: str, thoughts: List[Dict[str, Any]]) -> bool:
+        """Save (overwrite) all thoughts for a session to MongoDB; False if it failed"""
+        return self.save_thoughts_bulk([(session_id, thoughts)])
     
-    def save_thoughts(self, session_id: str, thoughts: List[Dict[str, Any]]):
-        """Save thoughts for a session to MongoDB"""
+    @_mongo_op(default=False, log=False)
+    def save_thoughts_bulk(self, items: List[Tuple[str, List[Dict[str, Any]]]]) -> bool:
+        """Save thoughts for several sessions in a single bulk_write round trip; False if it failed"""
+        if not items:
+            return True
+        
+        timestamp = time.time()
+        ops = []
+        for session_id, thoughts in items:
+            self._bump_version(session_id)
+            ops.extend(self._flush_to_buckets(session_id, thoughts, timestamp))
+        
+        # Unordered so one failing session doesn't block the rest
+        self._collection.bulk_write(ops, ordered=False)
+        for session_id, _ in items:
+            self._bump_version(session_id)
+        return True
+    
+    def _flush_to_buckets(self, session_id: str, thoughts: List[Dict[str, Any]],
+                          timestamp: float, bucket_size: int = BUCKET_SIZE) -> List[Any]:
+        """Build the write ops that overwrite a session with `thoughts`, bucket by bucket
+        
+        Steps are kept as given; they must run 0..n-1 (in any order), since
+        step `s` is stored at position s % bucket_size of bucket s // bucket_size.
+        """
+        thoughts = sorted(thoughts, key=lambda thought: thought.get("step", -1))
+        if [thought.get("step") for thought in thoughts] != list(range(len(thoughts))):
+            raise ValueError(f"Thoughts for session {session_id} must have steps 0..{len(thoughts) - 1}")
+        bucket_count = -(-len(thoughts) // bucket_size)
+        
+        # Drop buckets past the new end, then replace every remaining bucket
+        ops = [DeleteMany(
+            {"session_id": session_id, "bucket": {"$gte": bucket_count}},
+            hint=self._session_hint
+        )]
+        for bucket in range(bucket_count):
+            samples = thoughts[bucket * bucket_size:(bucket + 1) * bucket_size]
+            ops.append(ReplaceOne(
+                {"session_id": session_id, "bucket": bucket},
+                {
+                    "session_id": session_id,
+                    "bucket": bucket,
+                    "nsamples": len(samples),
+                    "thoughts": samples,
+                    "updated_at": timestamp
+                },
+                upsert=True,
+                hint=self._session_hint
+            ))
+        return ops
+    
+    @_mongo_op(default=False, log=False)
+    def append_thought(self, session_id: str, thought: Dict[str, Any]) -> bool:
+        """Push a single thought onto the end of its bucket; False if it was rejected
+        
+        The thought must be the session's next step: its bucket has to hold
+        exactly step % BUCKET_SIZE thoughts, and a new bucket is only started
+        once the previous one is full. Anything else - earlier steps missing
+        from MongoDB, a duplicate step - is rejected, and the caller should
+        save the full list instead.
+        """
+        step = thought["step"]
+        bucket, offset = divmod(step, BUCKET_SIZE)
+        if offset == 0 and bucket > 0 and self._collection.find_one(
+            {"session_id": session_id, "bucket": bucket - 1, "nsamples": BUCKET_SIZE},
+            {"_id": 1}, hint=self._session_hint
+        ) is None:
+            return False
+        
+        self._bump_version(session_id)
         try:
-            collection = self.get_collection()
-            if not collection:
-                # Silently fail if MongoDB not available - fallback will handle it
-                return
-            
-            # Prepare the document
-            doc = {
-                "session_id": session_id,
-                "thoughts": thoughts,
-                "updated_at": time.time(),
-                "total_thoughts": len(thoughts)
-            }
-            
-            # Upsert the document
-            collection.replace_one(
-                {"session_id": session_id},
-                doc,
-                upsert=True
+            # Only a new bucket may be upserted; the equality on nsamples
+            # makes an existing bucket 0 collide on the unique index instead
+            result = self._collection.update_one(
+                {"session_id": session_id, "bucket": bucket, "nsamples": offset},
+                {
+                    "$push": {"thoughts": thought},
+                    "$inc": {"nsamples": 1},
+                    "$set": {"updated_at": time.time()}
+                },
+                upsert=offset == 0
             )
-            
-        except Exception as e:
-            # Silently fail - fallback will handle it
-            pass
+        except DuplicateKeyError:
+            return False
+        if not result.matched_count and result.upserted_id is None:
+            return False
+        self._bump_version(session_id)
+        return True
     
+    @_mongo_op(default=[], log=False)
     def get_all_sessions(self) -> List[str]:
         """Get all session IDs that have sequential thinking data"""
-        try:
-            collection = self.get_collection()
-            if collection is None:
-                return []
-            
-            # Get all unique session IDs
-            session_ids = collection.distinct("session_id")
-            return session_ids
-            
-        except Exception as e:
-            return []
+        cached_at, session_ids = self._sessions_cache
+        if time.monotonic() - cached_at < SESSIONS_CACHE_TTL:
+            return list(session_ids)
+        
+        # session_id leads the (session_id, bucket) index, so this is a DISTINCT_SCAN
+        session_ids = self._collection.distinct("session_id")
+        legacy = self._legacy_collection()
+        if legacy is not None:
+            # Sessions not yet moved into buckets
+            session_ids = list(dict.fromkeys(session_ids + legacy.distinct("session_id")))
+        self._sessions_cache = (time.monotonic(), session_ids)
+        return list(session_ids)
     
+    @_mongo_op(default=lambda session_id: {"session_id": session_id, "thoughts": 0, "exists": False})
     def get_session_stats(self, session_id: str) -> Dict[str, Any]:
         """Get statistics for a session"""
-        try:
-            collection = self.get_collection()
-            if collection is None:
-                return {"session_id": session_id, "thoughts": 0, "exists": False}
-            
-            session_doc = collection.find_one({"session_id": session_id})
-            if not session_doc:
-                return {"session_id": session_id, "thoughts": 0, "exists": False}
-            
-            thoughts = session_doc.get("thoughts", [])
-            return {
+        key = self._cache_key("stats", session_id)
+        stats = self._cache_get(key)
+        if stats is not None:
+            return dict(stats)
+        
+        # Only the bucket counters and the newest thought leave the server
+        buckets = list(self._collection.find(
+            {"session_id": session_id},
+            projection={"_id": 0, "nsamples": 1, "updated_at": 1,
+                        "latest": {"$arrayElemAt": ["$thoughts.text", -1]}},
+            sort=[("bucket", DESCENDING)],
+            hint=self._session_hint
+        ))
+        total = sum(bucket.get("nsamples", 0) for bucket in buckets)
+        if not total and self._migrate_legacy_session(session_id):
+            return self.get_session_stats(session_id)
+        if not total:
+            stats = {"session_id": session_id, "thoughts": 0, "exists": False}
+        else:
+            latest = buckets[0]
+            stats = {
                 "session_id": session_id,
-                "thoughts": len(thoughts),
-                "updated_at": session_doc.get("updated_at"),
+                "thoughts": total,
+                "updated_at": latest.get("updated_at"),
                 "exists": True,
-                "latest_thought": thoughts[-1]["text"][:100] + "..." if thoughts else None
+                "latest_thought": latest["latest"][:100] + "..." if latest.get("latest") else None
             }
-            
-        except Exception as e:
-            print(f"❌ Error getting session stats for {session_id}: {e}")
-            return {"session_id": session_id, "error": str(e)}
+        
+        self._cache_set(key, stats)
+        return dict(stats)
     
+    @_mongo_op(default=False)
     def delete_session(self, session_id: str) -> bool:
         """Delete all thoughts for a session"""
-        try:
-            collection = self.get_collection()
-            if collection is None:
-                return False
-            
-            result = collection.delete_one({"session_id": session_id})
-            return result.deleted_count > 0
-            
-        except Exception as e:
-            print(f"❌ Error deleting session {session_id}: {e}")
-            return False
+        self._bump_version(session_id)
+        result = self._collection.delete_many({"session_id": session_id}, hint=self._session_hint)
+        deleted = result.deleted_count
+        legacy = self._legacy_collection()
+        if legacy is not None:
+            deleted += legacy.delete_one({"session_id": session_id}).deleted_count
+        self._forget_session(session_id)
+        self._sessions_cache = (0.0, [])
+        return deleted > 0
 
 # Global manager instance
 _sequential_thinking_manager = None
+_manager_lock = threading.Lock()
 
 def get_sequential_thinking_manager() -> SequentialThinkingManager:
     """Get the global sequential thinking manager instance"""
     global _sequential_thinking_manager
     if _sequential_thinking_manager is None:
-        _sequential_thinking_manager = SequentialThinkingManager()
-    return _sequential_thinking_manager
\ No newline at end of file
+        with _manager_lock:
+            if _sequential_thinking_manager is None:
+                _sequential_thinking_manager = SequentialThinkingManager()
+    return _sequential_thinking_manager
@@ -0,0 +1,79 @@
+"""
+Unit tests for the GitHub token rate limiters (no network or tokens needed)
+"""
+import time
+
+from github_ai_models import GitHubAITokenManager, SlidingWindowCounter, TokenBucket
+
+TOKEN_A = "a" * 40
+TOKEN_B = "b" * 40
+
+def test_token_bucket_refill():
+    """Buckets refill at `rate` per second, capped at capacity"""
+    bucket = TokenBucket(capacity=10, rate=2, tokens=0, last_refill=100.0)
+    
+    assert bucket.available(103.0) == 6
+    assert bucket.tokens == 0  # available() doesn't mutate
+    
+    bucket.refill(103.0)
+    assert (bucket.tokens, bucket.last_refill) == (6, 103.0)
+    
+    # A clock reading from before the last refill changes nothing
+    bucket.refill(101.0)
+    assert (bucket.tokens, bucket.last_refill) == (6, 103.0)
+    
+    assert bucket.available(1000.0) == 10
+
+def test_sliding_window_limit_and_wait():
+    """A full window rejects requests until the next segment boundary"""
+    window = SlidingWindowCounter(limit=10, window=60, segments=6, now=1000.0)
+    
+    assert all(window.try_acquire(1000.0) for _ in range(10))
+    assert not window.try_acquire(1000.0)
+    assert window.time_until_available(1005.0) == 5.0
+    
+    window = SlidingWindowCounter(limit=10, window=60, segments=6, now=1000.0)
+    assert window.time_until_available(1000.0) == 0.0
+
+def test_sliding_window_weights_oldest_segment():
+    """The partially expired oldest segment counts by the fraction still in the window"""
+    window = SlidingWindowCounter(limit=10, window=60, segments=6, now=1000.0)
+    for _ in range(10):
+        window.try_acquire(1000.0)
+    
+    # Half of the [1000, 1010) segment has slid out of the window
+    assert window.weighted_count(1065.0) == 5.0
+    assert window.try_acquire(1065.0)
+    
+    # ...and all of it once the next segment starts
+    assert window.weighted_count(1070.0) == 1.0
+
+def test_token_manager_skips_exhausted_token():
+    """Requests go to the token that still has budget"""
+    manager = GitHubAITokenManager([TOKEN_A, TOKEN_B], capacity=5, rate=1)
+    bucket = manager.buckets[0]
+    with bucket.lock:
+        bucket.tokens = 0
+        bucket.last_refill = time.monotonic() + 3600  # no refill during the test
+    
+    assert manager.get_token() == TOKEN_B
+    assert manager.token_usage[TOKEN_B]["count"] == 1
+    assert manager.token_usage[TOKEN_A]["count"] == 0
+
+def test_token_manager_prefers_most_headroom():
+    """The token with the most remaining budget is tried first"""
+    manager = GitHubAITokenManager([TOKEN_A, TOKEN_B], capacity=5, rate=1)
+    manager.buckets[0].tokens = 1
+    
+    assert manager.get_token() == TOKEN_B
+
+def test_token_manager_gives_up_when_all_exhausted():
+    """With every token limited, get_token returns None instead of blocking"""
+    manager = GitHubAITokenManager([TOKEN_A, TOKEN_B], capacity=5, rate=1)
+    for bucket in manager.buckets:
+        bucket.tokens = 0
+        bucket.last_refill = time.monotonic() + 3600
+    
+    start = time.monotonic()
+    assert manager.get_token(max_wait=0.1) is None
+    assert time.monotonic() - start < 1.0
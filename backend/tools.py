@@ -1,15 +1,27 @@
 from __future__ import annotations
 import os
 import json
+import hashlib
+import logging
+import atexit
+import queue
 import requests
-import wikipedia
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import urllib.parse
 import time
 import math
 import pathlib
+import tempfile
 import uuid
 import textwrap
 import re
-from typing import Dict, Any, List, Optional
+import functools
+import inspect
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Optional, Tuple
 from langchain.tools import tool
 from ddgs import DDGS
 from dotenv import load_dotenv
@@ -19,15 +31,86 @@ from scrapingant_client import ScrapingAntClient
 
 try:
     import numpy as np
-    from sentence_transformers import SentenceTransformer, util
+    from sentence_transformers import SentenceTransformer
     _SENTENCE_TRANSFORMERS_AVAILABLE = True
 except ImportError:
     _SENTENCE_TRANSFORMERS_AVAILABLE = False
     np = None
 
+try:
+    import xxhash
+    _XXHASH_AVAILABLE = True
+except ImportError:
+    _XXHASH_AVAILABLE = False
+
+try:
+    import tiktoken
+    _TIKTOKEN_AVAILABLE = True
+except ImportError:
+    _TIKTOKEN_AVAILABLE = False
+
+# orjson (C extension) for API bodies/responses and the thought file backup,
+# with a stdlib fallback; both loads() accept bytes
+try:
+    import orjson
+    _json_loads = orjson.loads
+    
+    def _json_dumps(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_SERIALIZE_NUMPY)
+    
+    def _json_line(obj) -> bytes:
+        return orjson.dumps(obj, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_SERIALIZE_NUMPY)
+except ImportError:
+    _json_loads = json.loads
+    
+    def _json_dumps(obj) -> bytes:
+        return json.dumps(obj).encode('utf-8')
+    
+    def _json_line(obj) -> bytes:
+        return (json.dumps(obj, separators=(',', ':')) + '\n').encode('utf-8')
+
 load_dotenv()
+
+logger = logging.getLogger(__name__)
 os.environ["LANGCHAIN_TRACING_V2"] = "false"
 
+# Shared HTTP session so tools reuse pooled keep-alive connections (and TLS
+# sessions) instead of a fresh TCP+TLS handshake per request
+_SESSION = requests.Session()
+_SESSION.mount("https://", HTTPAdapter(
+    pool_connections=20,
+    pool_maxsize=20,
+    max_retries=Retry(total=2, backoff_factor=0.2)
+))
+_SESSION.headers["User-Agent"] = "ai-assistant-tools/1.0"
+
+class _TTLCache:
+    """Small thread-safe LRU cache whose entries expire after `ttl` seconds."""
+    
+    def __init__(self, maxsize: int, ttl: float):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()  # key -> (expires_at, value), least recent first
+        self._lock = threading.Lock()
+    
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry[0] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry[1]
+    
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (time.monotonic() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
 # Global variable to store the last played track ID for Spotify embed
 _last_played_track_id = None
 
@@ -40,9 +123,94 @@ def clear_last_played_track_id():
     global _last_played_track_id
     _last_played_track_id = None
 
+# Tokens that name a specific thing - numbers ("3.11", "2024") and capitalized
+# words ("Python", "NASA") - and so must match exactly for a semantic hit
+_SPECIFIC_TOKEN_RE = re.compile(r'\b(?:\w*\d[\w.]*|[A-Z]\w*)')
+
+def _specific_tokens(query: str) -> frozenset:
+    """Numbers and capitalized words of a query, compared case-insensitively."""
+    return frozenset(token.lower() for token in _SPECIFIC_TOKEN_RE.findall(query))
+
+def _semantic_cached(tool_name: str, ttl: float, threshold: Optional[float] = 0.92,
+                     maxsize: int = 256, error_prefixes: tuple = ()):
+    """
+    Reuse a lookup tool's recent answer for the same or a near-duplicate query.
+    
+    The first parameter is the query; any other arguments must match exactly.
+    Queries match when their normalized text is equal or, with the embedding
+    model loaded, when the cosine similarity is at least `threshold`
+    (threshold=None matches normalized text only). A semantic match also
+    needs the same numbers and capitalized words, so "python 3.11" never
+    answers "python 3.12". Results starting with one of `error_prefixes` are
+    never cached.
+    """
+    def decorator(func):
+        signature = inspect.signature(func)
+        query_param = next(iter(signature.parameters))
+        entries = OrderedDict()  # (normalized query, variant) -> (expires_at, vector, result, specific tokens)
+        lock = threading.Lock()
+        
+        def lookup(key, vector, specific):
+            now = time.monotonic()
+            with lock:
+                for stale in [k for k, entry in entries.items() if entry[0] <= now]:
+                    del entries[stale]
+                
+                entry = entries.get(key)
+                if entry is None and vector is not None:
+                    # Closest live entry with the same extra arguments, scored
+                    # against all candidates in one matrix-vector product
+                    candidates = [
+                        candidate for (query, variant), candidate in entries.items()
+                        if variant == key[1] and candidate[1] is not None and candidate[3] == specific
+                    ]
+                    if candidates:
+                        scores = np.stack([candidate[1] for candidate in candidates]) @ vector
+                        best = int(np.argmax(scores))
+                        if scores[best] >= threshold:
+                            entry = candidates[best]
+                return entry[2] if entry is not None else None
+        
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = dict(bound.arguments)
+            query = str(arguments.pop(query_param)).strip()
+            key = (" ".join(query.lower().split()), tuple(sorted(arguments.items())))
+            
+            vector = None
+            if threshold is not None and _embed is not None and key[0]:
+                try:
+                    vector = _embed_batch([key[0]])[0]
+                except Exception:
+                    vector = None
+            
+            specific = _specific_tokens(query)
+            cached = lookup(key, vector, specific)
+            if cached is not None:
+                logger.debug("%s cache hit for %r", tool_name, query)
+                return cached
+            
+            result = func(*args, **kwargs)
+            if isinstance(result, str) and not result.startswith(error_prefixes):
+                with lock:
+                    entries[key] = (time.monotonic() + ttl, vector, result, specific)
+                    entries.move_to_end(key)
+                    while len(entries) > maxsize:
+                        entries.popitem(last=False)
+            return result
+        return wrapper
+    return decorator
+
 # ------------------------------------------------
 #  Weather
 # ------------------------------------------------
+# Coordinates practically never change; Nominatim is slow and limited to 1 req/s
+_GEO_CACHE = _TTLCache(maxsize=2048, ttl=86400)
+# Forecasts go stale quickly, so they are only reused for a few minutes
+_WEATHER_CACHE = _TTLCache(maxsize=512, ttl=600)
+
 @tool
 def get_weather(location: str, include_forecast: bool = False) -> str:
     """
@@ -50,31 +218,36 @@ def get_weather(location: str, include_forecast: bool = False) -> str:
     Global coverage with 1km resolution, no API key required.
     """
     try:
-        # Geocoding with proper error handling
-        geo_url = "https://nominatim.openstreetmap.org/search"
-        geo_params = {
-            "q": location.strip(),
-            "format": "json",
-            "limit": 1,
-            "accept-language": "en"
-        }
-        geo_headers = {"User-Agent": "weather-tool/1.0"}
-        
-        geo_resp = requests.get(
-            geo_url,
-            params=geo_params,
-            headers=geo_headers,
-            timeout=10
-        )
-        geo_resp.raise_for_status()
-        geo_data = geo_resp.json()
-        
-        if not geo_data:
-            return f"Location '{location}' not found. Please try a more specific location."
+        geo_key = location.strip().lower()
+        geo = _GEO_CACHE.get(geo_key)
+        if geo is None:
+            # Geocoding with proper error handling
+            geo_url = "https://nominatim.openstreetmap.org/search"
+            geo_params = {
+                "q": location.strip(),
+                "format": "json",
+                "limit": 1,
+                "accept-language": "en"
+            }
+            geo_resp = _SESSION.get(
+                geo_url,
+                params=geo_params,
+                timeout=10
+            )
+            geo_resp.raise_for_status()
+            geo_data = _json_loads(geo_resp.content)
+            
+            if not geo_data:
+                return f"Location '{location}' not found. Please try a more specific location."
+            
+            geo = (
+                float(geo_data[0]["lat"]),
+                float(geo_data[0]["lon"]),
+                geo_data[0].get("display_name", location)
+            )
+            _GEO_CACHE.set(geo_key, geo)
         
-        lat = float(geo_data[0]["lat"])
-        lon = float(geo_data[0]["lon"])
-        city_name = geo_data[0].get("display_name", location)
+        lat, lon, city_name = geo
         
         # Weather API call
         weather_url = "https://api.open-meteo.com/v1/forecast"
@@ -103,9 +276,13 @@ def get_weather(location: str, include_forecast: bool = False) -> str:
                 "forecast_days": 5
             })
         
-        weather_resp = requests.get(weather_url, params=weather_params, timeout=10)
-        weather_resp.raise_for_status()
-        weather_data = weather_resp.json()
+        weather_key = (lat, lon, include_forecast)
+        weather_data = _WEATHER_CACHE.get(weather_key)
+        if weather_data is None:
+            weather_resp = _SESSION.get(weather_url, params=weather_params, timeout=10)
+            weather_resp.raise_for_status()
+            weather_data = _json_loads(weather_resp.content)
+            _WEATHER_CACHE.set(weather_key, weather_data)
         
         # Parse current weather
         current = weather_data["current"]
@@ -149,71 +326,134 @@ def get_weather(location: str, include_forecast: bool = False) -> str:
     except Exception as e:
         return f"Unexpected error getting weather: {str(e)}"
 
+# WMO weather codes (0-99) used by Open-Meteo
+_WEATHER_CODES = {
+    0: "Clear sky",
+    1: "Mainly clear",
+    2: "Partly cloudy", 
+    3: "Overcast",
+    45: "Fog",
+    48: "Depositing rime fog",
+    51: "Light drizzle",
+    53: "Moderate drizzle",
+    55: "Dense drizzle",
+    61: "Slight rain",
+    63: "Moderate rain",
+    65: "Heavy rain",
+    71: "Slight snow",
+    73: "Moderate snow",
+    75: "Heavy snow",
+    95: "Thunderstorm",
+    96: "Thunderstorm with slight hail",
+    99: "Thunderstorm with heavy hail"
+}
+# Flat table so a lookup is a list index
+_WEATHER_TABLE = tuple(_WEATHER_CODES.get(code, "Unknown conditions") for code in range(100))
+
 def _get_weather_description(code: int) -> str:
     """Convert WMO weather code to description."""
-    weather_codes = {
-        0: "Clear sky",
-        1: "Mainly clear",
-        2: "Partly cloudy", 
-        3: "Overcast",
-        45: "Fog",
-        48: "Depositing rime fog",
-        51: "Light drizzle",
-        53: "Moderate drizzle",
-        55: "Dense drizzle",
-        61: "Slight rain",
-        63: "Moderate rain",
-        65: "Heavy rain",
-        71: "Slight snow",
-        73: "Moderate snow",
-        75: "Heavy snow",
-        95: "Thunderstorm",
-        96: "Thunderstorm with slight hail",
-        99: "Thunderstorm with heavy hail"
-    }
-    return weather_codes.get(code, "Unknown conditions")
+    if 0 <= code < len(_WEATHER_TABLE):
+        return _WEATHER_TABLE[int(code)]
+    return "Unknown conditions"
 
 # ------------------------------------------------
 #  Wikipedia
 # ------------------------------------------------
+WIKIPEDIA_REST_URL = "https://en.wikipedia.org/api/rest_v1"
+WIKIPEDIA_API_URL = "https://en.wikipedia.org/w/api.php"
+
 @tool
+@_semantic_cached("wikipedia_lookup", ttl=3600, threshold=0.95,
+                  error_prefixes=("Multiple articles", "No Wikipedia article", "Error accessing"))
 def wikipedia_lookup(title: str) -> str:
     """Get Wikipedia article summary with proper error handling."""
+    title = title.strip()
     try:
-        wikipedia.set_lang("en")
         # Try exact match first
-        summary = wikipedia.summary(title.strip(), sentences=8, auto_suggest=False)
-        return summary
-    except wikipedia.exceptions.DisambiguationError as e:
-        # Return top 5 options for disambiguation
-        options = e.options[:5]
-        return f"Multiple articles found for '{title}'. Did you mean: {', '.join(options)}"
-    except wikipedia.exceptions.PageError:
-        # Try with auto-suggest
-        try:
-            summary = wikipedia.summary(title.strip(), sentences=8, auto_suggest=True)
-            return summary
-        except:
+        summary = _wikipedia_summary(title)
+        if summary is None:
+            # Try the closest suggestion
+            suggestions = _wikipedia_suggestions(title, limit=1)
+            summary = _wikipedia_summary(suggestions[0]) if suggestions else None
+        if summary is None:
             return f"No Wikipedia article found for '{title}'. Please check spelling or try a different search term."
+        
+        if summary.get("type") == "disambiguation":
+            # Return top 5 options for disambiguation
+            options = [option for option in _wikipedia_suggestions(title, limit=6)
+                       if option != summary.get("title")][:5]
+            return f"Multiple articles found for '{title}'. Did you mean: {', '.join(options)}"
+        
+        return summary.get("extract") or f"No Wikipedia article found for '{title}'. Please check spelling or try a different search term."
     except Exception as e:
         return f"Error accessing Wikipedia: {str(e)}"
 
+def _wikipedia_summary(title: str) -> Optional[Dict[str, Any]]:
+    """Page summary from the MediaWiki REST API in one GET (None if there is no such page)."""
+    response = _SESSION.get(
+        f"{WIKIPEDIA_REST_URL}/page/summary/{urllib.parse.quote(title.replace(' ', '_'), safe='')}",
+        timeout=5
+    )
+    if response.status_code == 404:
+        return None
+    response.raise_for_status()
+    return _json_loads(response.content)
+
+def _wikipedia_suggestions(query: str, limit: int = 5) -> List[str]:
+    """Article titles matching a query, via the opensearch API."""
+    response = _SESSION.get(
+        WIKIPEDIA_API_URL,
+        params={"action": "opensearch", "search": query, "limit": limit,
+                "namespace": 0, "format": "json"},
+        timeout=5
+    )
+    response.raise_for_status()
+    return _json_loads(response.content)[1]
+
 # ------------------------------------------------
 #  DuckDuckGo Search
 # ------------------------------------------------
+# One DDGS client (and its HTTP connections) shared by the search, news and
+# lyrics tools; replaced after a failure in case its connection went bad
+_ddgs_client = None
+_ddgs_lock = threading.Lock()
+
+def _ddgs_search(method: str, query: str, **kwargs) -> List[Dict[str, Any]]:
+    """Run a DDGS search method on the shared client, retrying once on a fresh client.
+    
+    DDGS stops querying engines once `max_results` results are in and returns
+    a list, so the limit passed here is what bounds the work.
+    """
+    global _ddgs_client
+    for attempt in range(2):
+        with _ddgs_lock:
+            if _ddgs_client is None:
+                _ddgs_client = DDGS(timeout=10)
+            client = _ddgs_client
+        try:
+            return getattr(client, method)(query, **kwargs)
+        except Exception:
+            with _ddgs_lock:
+                if _ddgs_client is client:
+                    _ddgs_client = None
+            if attempt:
+                raise
+
 @tool
+@_semantic_cached("web_search", ttl=900,
+                  error_prefixes=("Please provide", "No search results", "Search error"))
 def web_search(query: str, max_results: int = 3) -> str:
     """Search the web using DuckDuckGo with robust error handling."""
     try:
         if not query.strip():
             return "Please provide a search query."
         
-        with DDGS() as ddgs:
-            results = list(ddgs.text(
-                keywords=query.strip(),
-                max_results=min(max_results, 10),
-                safesearch='moderate'
-            ))
+        results = _ddgs_search(
+            "text",
+            query.strip(),
+            max_results=min(max_results, 10),
+            safesearch='moderate'
+        )
         
         if not results:
             return f"No search results found for '{query}'"
@@ -234,18 +474,20 @@ def web_search(query: str, max_results: int = 3) -> str:
         return f"Search error: {str(e)}"
 
 @tool
+@_semantic_cached("latest_news", ttl=300,
+                  error_prefixes=("Please provide", "No recent news", "News search error"))
 def latest_news(topic: str, max_results: int = 5) -> str:
     """Get latest news headlines for a topic using DuckDuckGo."""
     try:
         if not topic.strip():
             return "Please provide a news topic."
         
-        with DDGS() as ddgs:
-            news_results = list(ddgs.news(
-                keywords=topic.strip(),
-                max_results=min(max_results, 10),
-                safesearch='moderate'
-            ))
+        news_results = _ddgs_search(
+            "news",
+            topic.strip(),
+            max_results=min(max_results, 10),
+            safesearch='moderate'
+        )
         
         if not news_results:
             return f"No recent news found for '{topic}'"
@@ -266,6 +508,156 @@ def latest_news(topic: str, max_results: int = 5) -> str:
 # ------------------------------------------------
 #  Resume Processing with Mistral
 # ------------------------------------------------
+def _read_sse_content(response) -> str:
+    """Accumulate the content deltas of a streamed chat completion."""
+    parts = []
+    for line in response.iter_lines():
+        if not line.startswith(b"data:"):
+            continue
+        data = line[5:].strip()
+        if data == b"[DONE]":
+            break
+        choices = _json_loads(data).get("choices") or [{}]
+        delta = choices[0].get("delta", {}).get("content")
+        if delta:
+            parts.append(delta)
+    return "".join(parts)
+
+# Markdown returned by scrapingant_page; JSON escaping rarely exceeds 4 bytes
+# per character, so reading stops once this many bytes have arrived
+SCRAPE_MAX_CHARS = 20000
+SCRAPE_MAX_BYTES = SCRAPE_MAX_CHARS * 4
+_MARKDOWN_FIELD_RE = re.compile(rb'"markdown"\s*:\s*"')
+
+def _read_markdown_field(response) -> Tuple[str, bool]:
+    """Stream the "markdown" field of a ScrapingAnt response; returns (markdown, truncated)."""
+    buf = bytearray()
+    complete = True
+    for chunk in response.iter_content(chunk_size=8192):
+        buf += chunk
+        if len(buf) >= SCRAPE_MAX_BYTES:
+            complete = False
+            break
+    response.close()
+    
+    if complete:
+        markdown = _json_loads(bytes(buf)).get("markdown", "")
+        return markdown, len(markdown) > SCRAPE_MAX_CHARS
+    
+    match = _MARKDOWN_FIELD_RE.search(buf)
+    if not match:
+        return "", True
+    
+    # Decode the string prefix, closing it ourselves if it was cut off
+    # (dropping up to one partial escape sequence at the cut)
+    text = buf[match.end():].decode("utf-8", "ignore")
+    for trim in range(7):
+        try:
+            return json.decoder.scanstring(text[:len(text) - trim] + '"', 0)[0], True
+        except ValueError:
+            continue
+    return "", True
+
+def _extract_pdf_text(pdf_path: str) -> str:
+    """Extract text with PDFium (native) when installed, else pure-Python PyPDF2."""
+    try:
+        import pypdfium2 as pdfium
+    except ImportError:
+        import PyPDF2
+        with open(pdf_path, 'rb') as file:
+            pdf_reader = PyPDF2.PdfReader(file)
+            return "".join(page.extract_text() + "\n" for page in pdf_reader.pages)
+    
+    pdf = pdfium.PdfDocument(pdf_path)
+    try:
+        parts = []
+        for page in pdf:
+            textpage = page.get_textpage()
+            try:
+                parts.append(textpage.get_text_range() + "\n")
+            finally:
+                textpage.close()
+                page.close()
+        return "".join(parts)
+    finally:
+        pdf.close()
+
+# Fixed part of the resume extraction prompt; only the resume text varies per call
+_RESUME_PROMPT_PREFIX = """Extract structured information from the resume text below and return only valid JSON with this exact structure:
+{
+    "personal_info": {
+        "name": "Full Name",
+        "email": "email@example.com", 
+        "phone": "phone number",
+        "location": "city, state/country",
+        "linkedin": "linkedin url",
+        "github": "github url"
+    },
+    "summary": "Professional summary",
+    "experience": [
+        {
+            "company": "Company Name",
+            "position": "Job Title", 
+            "duration": "Start - End Date",
+            "description": "Job description"
+        }
+    ],
+    "education": [
+        {
+            "institution": "School Name",
+            "degree": "Degree and Major",
+            "duration": "Start - End Date",
+            "gpa": "GPA if available"
+        }
+    ],
+    "skills": ["skill1", "skill2"],
+    "certifications": ["cert1", "cert2"],
+    "projects": [
+        {
+            "name": "Project Name",
+            "description": "Description",
+            "technologies": ["tech1", "tech2"]
+        }
+    ]
+}
+
+Resume text:
+"""
+
+# Structured resumes keyed by PDF content hash, so re-uploads skip the Mistral call.
+# Kept outside the source tree; only the parsed fields are stored, not the resume text
+RESUME_CACHE_DIR = pathlib.Path(os.getenv(
+    "RESUME_CACHE_DIR", pathlib.Path(tempfile.gettempdir()) / "ai-assistant-resume-cache"
+))
+RESUME_CACHE_TTL = 30 * 86400  # seconds
+
+def _file_digest(path: str) -> str:
+    """BLAKE2b hex digest of a file's bytes, read in 1 MiB blocks."""
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def _load_cached_resume(cache_path: pathlib.Path) -> Optional[Dict[str, Any]]:
+    """Cached structured resume, or None if missing, expired or unreadable."""
+    try:
+        if time.time() - cache_path.stat().st_mtime > RESUME_CACHE_TTL:
+            return None
+        return _json_loads(cache_path.read_bytes())
+    except (OSError, ValueError):
+        return None
+
+def _save_cached_resume(cache_path: pathlib.Path, structured_data: Dict[str, Any]):
+    """Write a structured resume to the cache (atomically, so readers never see a partial file)."""
+    try:
+        RESUME_CACHE_DIR.mkdir(mode=0o700, parents=True, exist_ok=True)
+        tmp_path = cache_path.with_suffix(".tmp")
+        tmp_path.write_bytes(_json_dumps(structured_data))
+        tmp_path.replace(cache_path)
+    except OSError as e:
+        print(f"⚠️ Could not cache resume: {e}")
+
 @tool
 def process_resume(resume_path: str) -> Dict[str, Any]:
     """
@@ -273,8 +665,6 @@ def process_resume(resume_path: str) -> Dict[str, Any]:
     Requires MISTRAL_API_KEY environment variable.
     """
     try:
-        import PyPDF2
-        
         mistral_api_key = os.getenv("MISTRAL_API_KEY")
         if not mistral_api_key:
             return {"error": "MISTRAL_API_KEY environment variable not set"}
@@ -283,18 +673,23 @@ def process_resume(resume_path: str) -> Dict[str, Any]:
             return {"error": f"File not found: {resume_path}"}
         
         # Extract text from PDF
-        text_content = ""
         try:
-            with open(resume_path, 'rb') as file:
-                pdf_reader = PyPDF2.PdfReader(file)
-                for page in pdf_reader.pages:
-                    text_content += page.extract_text() + "\n"
+            text_content = _extract_pdf_text(resume_path)
+        except ImportError:
+            raise
         except Exception as e:
             return {"error": f"PDF reading failed: {str(e)}"}
         
         if not text_content.strip():
             return {"error": "No text content extracted from PDF"}
         
+        # Same PDF bytes as an earlier upload: reuse its parsed fields
+        cache_path = RESUME_CACHE_DIR / f"resume_{_file_digest(resume_path)}.json"
+        cached = _load_cached_resume(cache_path)
+        if cached is not None:
+            cached["raw_text"] = text_content
+            return cached
+        
         # Call Mistral API
         headers = {
             "Authorization": f"Bearer {mistral_api_key}",
@@ -306,80 +701,32 @@ def process_resume(resume_path: str) -> Dict[str, Any]:
             "messages": [
                 {
                     "role": "user",
-                    "content": f"""Extract structured information from this resume text and return only valid JSON:
-
-{text_content}
-
-Return JSON with this exact structure:
-{{
-    "personal_info": {{
-        "name": "Full Name",
-        "email": "email@example.com", 
-        "phone": "phone number",
-        "location": "city, state/country",
-        "linkedin": "linkedin url",
-        "github": "github url"
-    }},
-    "summary": "Professional summary",
-    "experience": [
-        {{
-            "company": "Company Name",
-            "position": "Job Title", 
-            "duration": "Start - End Date",
-            "description": "Job description"
-        }}
-    ],
-    "education": [
-        {{
-            "institution": "School Name",
-            "degree": "Degree and Major",
-            "duration": "Start - End Date",
-            "gpa": "GPA if available"
-        }}
-    ],
-    "skills": ["skill1", "skill2"],
-    "certifications": ["cert1", "cert2"],
-    "projects": [
-        {{
-            "name": "Project Name",
-            "description": "Description",
-            "technologies": ["tech1", "tech2"]
-        }}
-    ]
-}}"""
+                    "content": _RESUME_PROMPT_PREFIX + text_content
                 }
             ],
-            "temperature": 0.1
+            "temperature": 0.1,
+            "response_format": {"type": "json_object"},
+            "stream": True
         }
         
-        response = requests.post(
+        # Stream the completion as server-sent events; the read timeout then
+        # bounds each gap between chunks rather than the whole generation
+        with _SESSION.post(
             "https://api.mistral.ai/v1/chat/completions",
             headers=headers,
-            json=payload,
-            timeout=60
-        )
-        
-        if response.status_code != 200:
-            return {"error": f"Mistral API error ({response.status_code}): {response.text}"}
-        
-        result = response.json()
-        content = result['choices'][0]['message']['content']
+            data=_json_dumps(payload),
+            stream=True,
+            timeout=(10, 60)
+        ) as response:
+            if response.status_code != 200:
+                return {"error": f"Mistral API error ({response.status_code}): {response.text}"}
+            
+            content = _read_sse_content(response)
         
-        # Parse JSON response
+        # Parse JSON response (JSON mode, so no markdown fences to strip)
         try:
-            # Clean up markdown formatting if present
-            if "```json" in content:
-                json_start = content.find("```json") + 7
-                json_end = content.find("```", json_start)
-                json_str = content[json_start:json_end].strip()
-            elif "```" in content:
-                json_start = content.find("```") + 3
-                json_end = content.find("```", json_start)
-                json_str = content[json_start:json_end].strip()
-            else:
-                json_str = content.strip()
-            
-            structured_data = json.loads(json_str)
+            structured_data = _json_loads(content)
+            _save_cached_resume(cache_path, structured_data)
             structured_data["raw_text"] = text_content
             return structured_data
             
@@ -391,7 +738,7 @@ Return JSON with this exact structure:
             }
             
     except ImportError:
-        return {"error": "PyPDF2 not installed. Run: pip install PyPDF2"}
+        return {"error": "No PDF library installed. Run: pip install pypdfium2 (or PyPDF2)"}
     except Exception as e:
         return {"error": f"Unexpected error: {str(e)}"}
 
@@ -410,25 +757,26 @@ def scrapingant_page(url: str) -> str:
         if not url.startswith(('http://', 'https://')):
             url = 'https://' + url
         
-        response = requests.get(
+        response = _SESSION.get(
             "https://api.scrapingant.com/v2/markdown",
             params={
                 "url": url,
                 "x-api-key": api_key
             },
-            timeout=30
+            timeout=30,
+            stream=True
         )
         
         if response.status_code == 200:
-            data = response.json()
-            markdown_content = data.get("markdown", "")
+            # Long pages stop downloading once the size limit is reached
+            markdown_content, truncated = _read_markdown_field(response)
             
             if not markdown_content:
                 return f"No content extracted from {url}"
             
             # Limit response size
-            if len(markdown_content) > 20000:
-                markdown_content = markdown_content[:20000] + "\n\n[Content truncated due to length...]"
+            if truncated:
+                markdown_content = markdown_content[:SCRAPE_MAX_CHARS] + "\n\n[Content truncated due to length...]"
             
             return markdown_content
         else:
@@ -442,15 +790,45 @@ def scrapingant_page(url: str) -> str:
 # ------------------------------------------------
 #  Spotify Integration
 # ------------------------------------------------
+# Per-candidate match scores are only printed when debugging track selection
+SPOTIFY_DEBUG = os.getenv("SPOTIFY_DEBUG", "").lower() in ("1", "true")
+
+_spotify_client = None
+_spotify_lock = threading.Lock()
+
 def get_spotify():
-    return spotipy.Spotify(auth_manager=SpotifyOAuth(
-        client_id=os.environ.get("SPOTIFY_CLIENT_ID"),
-        client_secret=os.environ.get("SPOTIFY_CLIENT_SECRET"),
-        redirect_uri=os.environ.get("SPOTIFY_REDIRECT_URI"),
-        scope="user-read-playback-state user-modify-playback-state",
-        open_browser=False,
-        cache_path=".spotify_cache"
-    ))
+    """Shared Spotify client; its auth manager refreshes the token when it expires."""
+    global _spotify_client
+    if _spotify_client is None:
+        with _spotify_lock:
+            if _spotify_client is None:
+                _spotify_client = spotipy.Spotify(
+                    auth_manager=SpotifyOAuth(
+                        client_id=os.environ.get("SPOTIFY_CLIENT_ID"),
+                        client_secret=os.environ.get("SPOTIFY_CLIENT_SECRET"),
+                        redirect_uri=os.environ.get("SPOTIFY_REDIRECT_URI"),
+                        scope="user-read-playback-state user-modify-playback-state",
+                        open_browser=False,
+                        cache_path=".spotify_cache",
+                        requests_session=_SESSION
+                    ),
+                    requests_session=_SESSION
+                )
+    return _spotify_client
+
+# Users rarely switch devices mid-conversation, so the device list is reused briefly
+_DEVICES_CACHE = _TTLCache(maxsize=1, ttl=5)
+_SPOTIFY_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix="spotify")
+
+def _get_devices(sp) -> List[Dict[str, Any]]:
+    """Available Spotify devices, cached for a few seconds."""
+    devices = _DEVICES_CACHE.get("devices")
+    if devices is None:
+        devices = sp.devices()["devices"]
+        # An empty list isn't cached so a newly opened player shows up at once
+        if devices:
+            _DEVICES_CACHE.set("devices", devices)
+    return devices
 
 @tool
 def search_tracks(query: str, limit: int = 5) -> str:
@@ -495,17 +873,22 @@ def play_smart_track(query: str) -> str:
         
         sp = get_spotify()
         
-        # Check for active devices
-        devices = sp.devices()["devices"]
-        if not devices:
-            return "No active Spotify device found. Please open Spotify on a device first."
-        
         # Search for track with better matching
         search_query = query.strip()
         print(f"🎵 SPOTIFY: Searching for: '{search_query}'")
         
+        # The device lookup and the search are independent round trips, so
+        # they run concurrently
+        devices_future = _SPOTIFY_POOL.submit(_get_devices, sp)
+        results_future = _SPOTIFY_POOL.submit(sp.search, q=search_query, type="track", limit=10)
+        
+        # Check for active devices
+        devices = devices_future.result()
+        if not devices:
+            return "No active Spotify device found. Please open Spotify on a device first."
+        
         # Try multiple search strategies for better results
-        results = sp.search(q=search_query, type="track", limit=10)
+        results = results_future.result()
         tracks = results.get("tracks", {}).get("items", [])
         
         if not tracks:
@@ -518,33 +901,27 @@ def play_smart_track(query: str) -> str:
         if not tracks:
             return f"No track found for '{query}'. Try being more specific or use different keywords."
         
-        # Find the best match by checking track names and artist names
-        best_match = None
+        # Score every candidate by word overlap with the query (track name + artists)
         query_words = set(search_query.lower().split())
-        
-        for track in tracks:
-            track_name = track['name'].lower()
-            artist_names = ' '.join(artist['name'].lower() for artist in track['artists'])
-            combined_text = f"{track_name} {artist_names}"
-            
-            # Calculate match score based on word overlap
-            track_words = set(combined_text.split())
-            match_score = len(query_words.intersection(track_words)) / len(query_words)
-            
-            print(f"🎵 SPOTIFY: Candidate - '{track['name']}' by {', '.join(a['name'] for a in track['artists'])} (score: {match_score:.2f})")
-            
-            if match_score > 0.3:  # At least 30% word match
-                best_match = track
-                break
-        
-        # If no good match found, use the first result
-        if not best_match:
-            best_match = tracks[0]
+        scores = [
+            len(query_words.intersection(
+                f"{track['name']} {' '.join(artist['name'] for artist in track['artists'])}".lower().split()
+            )) / max(len(query_words), 1)
+            for track in tracks
+        ]
+        best_index = max(range(len(tracks)), key=scores.__getitem__)
+        
+        if SPOTIFY_DEBUG:
+            for track, score in zip(tracks, scores):
+                print(f"🎵 SPOTIFY: Candidate - '{track['name']}' by {', '.join(a['name'] for a in track['artists'])} (score: {score:.2f})")
+        
+        # Best match needs at least 30% word overlap; otherwise use the first result
+        if scores[best_index] > 0.3:
+            track = tracks[best_index]
+        else:
+            track = tracks[0]
             print(f"🎵 SPOTIFY: No good match found, using first result")
         
-        track = best_match
-        
-        track = tracks[0]
         track_id = track["id"]
         track_name = track["name"]
         artists = ', '.join(artist['name'] for artist in track['artists'])
@@ -724,7 +1101,7 @@ def set_volume(percent: int) -> str:
             return "Volume must be between 0 and 100"
         
         sp = get_spotify()
-        devices = sp.devices()["devices"]
+        devices = _get_devices(sp)
         
         if not devices:
             return "No active device found"
@@ -756,14 +1133,14 @@ def get_lyrics() -> str:
         # Try Musixmatch API first
         try:
             api_url = "https://spotify-lyric-api.herokuapp.com/lyrics"
-            response = requests.get(
+            response = _SESSION.get(
                 api_url, 
                 params={"trackid": track_id}, 
                 timeout=10
             )
             
             if response.status_code == 200:
-                data = response.json()
+                data = _json_loads(response.content)
                 if not data.get("error") and data.get("lines"):
                     lyrics = "\n".join(line["words"] for line in data["lines"])
                     return f"Lyrics for {title} by {artists}:\n\n{lyrics}"
@@ -773,8 +1150,7 @@ def get_lyrics() -> str:
         # Fallback to DuckDuckGo search
         try:
             query = f"{title} {artists} lyrics"
-            with DDGS() as ddgs:
-                results = list(ddgs.text(keywords=query, max_results=3))
+            results = _ddgs_search("text", query, max_results=3)
             
             if results:
                 snippet = results[0]["body"]
@@ -796,103 +1172,476 @@ def get_lyrics() -> str:
 # Configuration
 MAX_DEPTH = 100
 MAX_TOKENS = 50000
+# Words marking a thought that corrects the previous one (never merged as a duplicate)
+_CONTRADICTION_RE = re.compile(r'\b(?:however|but|actually|wait|no)\b', re.IGNORECASE)
 EMBED_MODEL_NAME = "all-MiniLM-L6-v2"
 PERSIST_DIR = pathlib.Path(__file__).parent / "sequential_memory"
 PERSIST_DIR.mkdir(exist_ok=True)
 
-# Initialize embedding model
-_embed = None
-if _SENTENCE_TRANSFORMERS_AVAILABLE:
+INT8_MODEL_DIR = PERSIST_DIR / "minilm-int8"
+INT8_MODEL_FILE = "model_quantized.onnx"
+
+class _OnnxEmbedder:
+    """INT8 ONNX Runtime copy of the embedding model with a SentenceTransformer-style encode()."""
+    
+    def __init__(self, model_dir: pathlib.Path):
+        from optimum.onnxruntime import ORTModelForFeatureExtraction
+        from transformers import AutoTokenizer
+        self.tokenizer = AutoTokenizer.from_pretrained(model_dir)
+        self.model = ORTModelForFeatureExtraction.from_pretrained(model_dir, file_name=INT8_MODEL_FILE)
+    
+    def encode(self, texts, batch_size: int = 64, convert_to_numpy: bool = True,
+               normalize_embeddings: bool = False):
+        single = isinstance(texts, str)
+        if single:
+            texts = [texts]
+        
+        batches = []
+        for start in range(0, len(texts), batch_size):
+            inputs = self.tokenizer(texts[start:start + batch_size], padding=True,
+                                    truncation=True, max_length=256, return_tensors="np")
+            hidden = np.asarray(self.model(**inputs).last_hidden_state)
+            # Mean pooling over real tokens, as in the sentence-transformers model
+            mask = inputs["attention_mask"][..., None].astype(np.float32)
+            pooled = (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+            if normalize_embeddings:
+                pooled /= np.clip(np.linalg.norm(pooled, axis=1, keepdims=True), 1e-12, None)
+            batches.append(pooled)
+        
+        vectors = np.concatenate(batches)
+        return vectors[0] if single else vectors
+
+def _export_int8_model(model_dir: pathlib.Path):
+    """One-shot ONNX export of the embedding model plus dynamic INT8 weight quantization."""
+    from optimum.onnxruntime import ORTModelForFeatureExtraction
+    from onnxruntime.quantization import quantize_dynamic, QuantType
+    from transformers import AutoTokenizer
+    
+    model_id = f"sentence-transformers/{EMBED_MODEL_NAME}"
+    ORTModelForFeatureExtraction.from_pretrained(model_id, export=True).save_pretrained(model_dir)
+    AutoTokenizer.from_pretrained(model_id).save_pretrained(model_dir)
+    quantize_dynamic(str(model_dir / "model.onnx"), str(model_dir / INT8_MODEL_FILE),
+                     weight_type=QuantType.QInt8)
+
+def _load_embedder():
+    """Prefer the INT8 ONNX model (exported on first use); fall back to FP32 sentence-transformers."""
+    try:
+        if not (INT8_MODEL_DIR / INT8_MODEL_FILE).exists():
+            _export_int8_model(INT8_MODEL_DIR)
+        return _OnnxEmbedder(INT8_MODEL_DIR)
+    except Exception as e:
+        if not isinstance(e, ImportError):
+            print(f"⚠️ INT8 embedding model unavailable, using FP32: {e}")
+    
     try:
-        _embed = SentenceTransformer(EMBED_MODEL_NAME)
+        return SentenceTransformer(EMBED_MODEL_NAME)
     except Exception:
-        _embed = None
+        return None
 
+# Initialize embedding model
+_embed = _load_embedder() if _SENTENCE_TRANSFORMERS_AVAILABLE else None
+
+# Normalized embeddings keyed by text hash - the same thoughts and queries are
+# compared over and over, and each encode is a full model forward pass
+_EMBED_CACHE = _TTLCache(maxsize=4096, ttl=86400)
+
+@functools.cache
+def _token_encoder():
+    """cl100k_base BPE encoder, or None without tiktoken (or its encoding files)."""
+    if not _TIKTOKEN_AVAILABLE:
+        return None
+    try:
+        return tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        print(f"⚠️ tiktoken encoding unavailable, counting words instead: {e}")
+        return None
+
+@functools.lru_cache(maxsize=4096)
 def _tokens(text: str) -> int:
-    """Simple token counter based on whitespace."""
-    return len(text.split())
+    """BPE token count (whitespace word count without tiktoken), cached per text."""
+    encoder = _token_encoder()
+    if encoder is None:
+        return len(text.split())
+    return len(encoder.encode(text, disallowed_special=()))
+
+def _text_hash(text: str) -> str:
+    """Stable 16-char hex digest of the text (xxh3 when available)."""
+    data = text.encode('utf-8')
+    if _XXHASH_AVAILABLE:
+        return xxhash.xxh3_64_hexdigest(data)
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+def _embed_batch(texts: List[str]):
+    """Normalized embeddings for `texts` as one array, encoding only cache misses in a single batch."""
+    keys = [_text_hash(text) for text in texts]
+    vectors = [_EMBED_CACHE.get(key) for key in keys]
+    missing = [i for i, vector in enumerate(vectors) if vector is None]
+    if missing:
+        encoded = _embed.encode([texts[i] for i in missing], batch_size=64,
+                                convert_to_numpy=True, normalize_embeddings=True)
+        for i, vector in zip(missing, encoded):
+            vectors[i] = vector
+            _EMBED_CACHE.set(keys[i], vector)
+    return np.stack(vectors)
 
 def _semantic_hash(text: str) -> str:
     """Generate semantic hash for similarity checking."""
     if _embed is None:
-        return str(hash(text))[:16]
+        return _text_hash(text)
     
     try:
-        vec = _embed.encode(text, normalize_embeddings=True)
-        return str(np.packbits((vec > 0).astype(int)).tobytes().hex()[:16])
+        # Sign bit of every dimension (96 hex chars for MiniLM's 384 dims)
+        vec = _embed_batch([text])[0]
+        return np.packbits(vec > 0).tobytes().hex()
     except:
-        return str(hash(text))[:16]
+        return _text_hash(text)
 
-def _similarity(a: str, b: str) -> float:
-    """Calculate semantic similarity between texts."""
-    if _embed is None:
-        # Fallback to word overlap
-        words_a = set(a.lower().split())
-        words_b = set(b.lower().split())
-        if not words_a or not words_b:
-            return 0.0
-        return len(words_a & words_b) / len(words_a | words_b)
+# Below this approximate cosine, two signatures are never near-duplicates
+SIGNATURE_PREFILTER_FLOOR = 0.5
+
+def _signature_similarity(sig_a: str, sig_b: str) -> Optional[float]:
+    """Approximate cosine from two sign-bit signatures via Hamming distance (None if not comparable)."""
+    # Plain text hashes (no embedding model) and legacy 16-char ids carry no signal
+    if not sig_a or len(sig_a) != len(sig_b) or len(sig_a) <= 16:
+        return None
+    try:
+        distance = bin(int(sig_a, 16) ^ int(sig_b, 16)).count("1")
+    except ValueError:
+        return None
+    return 1.0 - 2.0 * distance / (len(sig_a) * 4)
+
+def _closest_thought(thoughts: List[Dict[str, Any]], text: str, semantic_id: str) -> Tuple[int, float]:
+    """Index of the prior thought most similar to `text` and its cosine similarity (-1 if none)."""
+    # Stored signatures rule out clearly different thoughts without embedding them
+    candidates = [
+        i for i, thought in enumerate(thoughts)
+        if (approx := _signature_similarity(thought.get("semantic_id", ""), semantic_id)) is None
+        or approx >= SIGNATURE_PREFILTER_FLOOR
+    ]
+    if not candidates:
+        return -1, 0.0
     
     try:
-        v1 = _embed.encode(a, normalize_embeddings=True)
-        v2 = _embed.encode(b, normalize_embeddings=True)
-        return float(util.cos_sim(v1, v2))
+        # Normalized vectors, so one matrix-vector product gives every cosine
+        vectors = _embed_batch([thoughts[i]["text"] for i in candidates] + [text])
+        scores = vectors[:-1] @ vectors[-1]
+        best = int(np.argmax(scores))
+        return candidates[best], float(scores[best])
     except:
-        return 0.0
+        return -1, 0.0
+
+# Sessions' thoughts are served from memory once loaded; writes are queued and
+# persisted by a background thread, so MongoDB and the file backup stay off
+# the request path
+# Entries are {"thoughts": [...], "total_tokens": int}, least recent first;
+# the running token total spares the budget check a pass over every thought
+_THOUGHT_CACHE: OrderedDict[str, Dict[str, Any]] = OrderedDict()
+_THOUGHT_CACHE_LOCK = threading.Lock()
+THOUGHT_CACHE_SESSIONS = 512  # sessions kept in memory
+_WRITE_QUEUE: queue.Queue = queue.Queue()
+WRITE_BATCH_WINDOW = 0.1  # seconds the writer waits to batch queued writes
+WRITE_WAIT_TIMEOUT = 5.0  # seconds a cold load or interpreter exit waits on queued writes
+_writer_thread = None
+_writer_lock = threading.Lock()
+# Writes queued but not yet persisted, per session; guarded by _PENDING_CHANGED
+_PENDING_WRITES: Dict[str, int] = {}
+_PENDING_CHANGED = threading.Condition()
+# Sessions whose MongoDB copy missed a write; their next flush sends the full
+# list instead of appends. Only touched by the writer thread
+_NEEDS_FULL_SAVE: set = set()
 
 def _load_thoughts(session_id: str) -> List[Dict[str, Any]]:
-    """Load thoughts from MongoDB storage with file fallback."""
-    try:
-        from sequential_thinking_mongodb import get_sequential_thinking_manager
-        manager = get_sequential_thinking_manager()
-        thoughts = manager.load_thoughts(session_id)
-        if thoughts:
-            return thoughts
-        # If MongoDB returns empty, try file fallback
-        return _load_thoughts_from_file(session_id)
-    except:
-        return _load_thoughts_from_file(session_id)
+    """Load thoughts from the in-process cache, then MongoDB, then the file backup."""
+    with _THOUGHT_CACHE_LOCK:
+        entry = _THOUGHT_CACHE.get(session_id)
+        if entry is not None:
+            _THOUGHT_CACHE.move_to_end(session_id)
+    if entry is None:
+        # An evicted session may still have writes queued; let them land first
+        _wait_for_session_writes(session_id)
+        try:
+            from sequential_thinking_mongodb import get_sequential_thinking_manager
+            manager = get_sequential_thinking_manager()
+            thoughts = manager.load_thoughts(session_id)
+            if not thoughts:
+                # If MongoDB returns empty, try file fallback
+                thoughts = _load_thoughts_from_file(session_id)
+        except:
+            thoughts = _load_thoughts_from_file(session_id)
+        entry = {"thoughts": thoughts, "total_tokens": sum(_tokens(t["text"]) for t in thoughts)}
+        with _THOUGHT_CACHE_LOCK:
+            entry = _THOUGHT_CACHE.setdefault(session_id, entry)
+            _evict_thought_sessions()
+    
+    # Callers mutate the thoughts they load, so hand out copies
+    return [dict(thought) for thought in entry["thoughts"]]
+
+def _session_tokens(session_id: str, thoughts: List[Dict[str, Any]]) -> int:
+    """Token total of a session, from the cache when it's there."""
+    with _THOUGHT_CACHE_LOCK:
+        entry = _THOUGHT_CACHE.get(session_id)
+    if entry is not None:
+        return entry["total_tokens"]
+    return sum(_tokens(t["text"]) for t in thoughts)
+
+def _evict_thought_sessions():
+    """Drop the least recently used sessions past the cap (caller holds the cache lock)."""
+    while len(_THOUGHT_CACHE) > THOUGHT_CACHE_SESSIONS:
+        _THOUGHT_CACHE.popitem(last=False)
 
 def _save_thoughts(session_id: str, thoughts: List[Dict[str, Any]]):
-    """Save thoughts to MongoDB storage with file fallback."""
+    """Replace a session's thoughts; persisted to MongoDB and the file backup in the background."""
+    _queue_thought_write("save", session_id, None, thoughts)
+
+def _append_thought(session_id: str, thought: Dict[str, Any], thoughts: List[Dict[str, Any]]):
+    """Persist a newly appended thought; `thoughts` is the full list including it."""
+    _queue_thought_write("append", session_id, thought, thoughts)
+
+def _clear_thoughts(session_id: str):
+    """Forget a session's thoughts and remove its file backup (after any queued writes)."""
+    _queue_thought_write("clear", session_id, None, None)
+
+def _queue_thought_write(kind: str, session_id: str, thought: Optional[Dict[str, Any]],
+                         thoughts: Optional[List[Dict[str, Any]]]):
+    """Update the cache now and queue the matching write for the background writer."""
+    snapshot = None if thoughts is None else [dict(t) for t in thoughts]
+    with _THOUGHT_CACHE_LOCK:
+        previous = _THOUGHT_CACHE.get(session_id)
+        if snapshot is None:
+            _THOUGHT_CACHE.pop(session_id, None)
+        else:
+            # An append only adds its own tokens; other writes recount
+            if kind == "append" and previous is not None:
+                total_tokens = previous["total_tokens"] + _tokens(thought["text"])
+            else:
+                total_tokens = sum(_tokens(t["text"]) for t in snapshot)
+            _THOUGHT_CACHE[session_id] = {"thoughts": snapshot, "total_tokens": total_tokens}
+            _THOUGHT_CACHE.move_to_end(session_id)
+            _evict_thought_sessions()
+    _start_thought_writer()
+    with _PENDING_CHANGED:
+        _PENDING_WRITES[session_id] = _PENDING_WRITES.get(session_id, 0) + 1
+    _WRITE_QUEUE.put((kind, session_id, thought and dict(thought), snapshot))
+
+def _wait_for_session_writes(session_id: str):
+    """Block (up to WRITE_WAIT_TIMEOUT) until the session's queued writes are persisted."""
+    with _PENDING_CHANGED:
+        if not _PENDING_CHANGED.wait_for(lambda: session_id not in _PENDING_WRITES,
+                                         timeout=WRITE_WAIT_TIMEOUT):
+            logger.warning("Loading session %s with writes still queued", session_id)
+
+def _finish_writes(batch: list):
+    """Mark a batch of queued writes as persisted (or given up on)."""
+    with _PENDING_CHANGED:
+        for write in batch:
+            session_id = write[1]
+            remaining = _PENDING_WRITES.get(session_id, 0) - 1
+            if remaining > 0:
+                _PENDING_WRITES[session_id] = remaining
+            else:
+                _PENDING_WRITES.pop(session_id, None)
+        _PENDING_CHANGED.notify_all()
+
+def _drain_at_exit():
+    """Give queued writes a bounded chance to land before the interpreter exits."""
+    if _writer_thread is None or not _writer_thread.is_alive():
+        return
+    with _PENDING_CHANGED:
+        if not _PENDING_CHANGED.wait_for(lambda: not _PENDING_WRITES, timeout=WRITE_WAIT_TIMEOUT):
+            logger.warning("Exiting with %d sessions' thoughts not persisted", len(_PENDING_WRITES))
+
+def _start_thought_writer():
+    """Start the background writer thread on first use."""
+    global _writer_thread
+    if _writer_thread is None:
+        with _writer_lock:
+            if _writer_thread is None:
+                _writer_thread = threading.Thread(target=_drain_thought_writes,
+                                                  name="thought-writer", daemon=True)
+                _writer_thread.start()
+                atexit.register(_drain_at_exit)
+
+def _drain_thought_writes():
+    """Writer loop: collect queued writes for WRITE_BATCH_WINDOW, then persist them together."""
+    while True:
+        batch = [_WRITE_QUEUE.get()]
+        deadline = time.monotonic() + WRITE_BATCH_WINDOW
+        while (remaining := deadline - time.monotonic()) > 0:
+            try:
+                batch.append(_WRITE_QUEUE.get(timeout=remaining))
+            except queue.Empty:
+                break
+        try:
+            _flush_thought_writes(batch)
+        except Exception as e:
+            logger.error("Error persisting thoughts: %s", e)
+        finally:
+            _finish_writes(batch)
+
+def _flush_thought_writes(batch: List[Tuple[str, str, Optional[Dict[str, Any]], Optional[List[Dict[str, Any]]]]]):
+    """Persist a batch of queued writes, coalesced to the latest state of each session."""
+    by_session: Dict[str, list] = {}
+    for write in batch:
+        by_session.setdefault(write[1], []).append(write)
+    
+    appends = []  # (session_id, new thoughts, latest thoughts) when only appends were queued
+    saves = []    # (session_id, latest thoughts) otherwise, sent in one bulk write
+    # Each session is handled on its own, so one bad session can't cost the
+    # rest of the batch their writes
+    for session_id, writes in by_session.items():
+        try:
+            kinds = [write[0] for write in writes]
+            if "clear" in kinds:
+                last_clear = len(kinds) - 1 - kinds[::-1].index("clear")
+                try:
+                    os.unlink(_path_for(session_id))
+                except FileNotFoundError:
+                    pass
+                writes = writes[last_clear + 1:]
+                if not writes:
+                    continue
+            
+            # Also save to file as backup - appends only add their lines
+            only_appends = all(write[0] == "append" for write in writes)
+            if only_appends:
+                _append_thoughts_to_file(session_id, [write[2] for write in writes], writes[-1][3])
+            else:
+                _save_thoughts_to_file(session_id, writes[-1][3])
+            
+            if only_appends and session_id not in _NEEDS_FULL_SAVE:
+                appends.append((session_id, [write[2] for write in writes], writes[-1][3]))
+            else:
+                saves.append((session_id, writes[-1][3]))
+        except Exception as e:
+            logger.error("Error persisting thoughts for session %s: %s", session_id, e)
+    
+    if not (appends or saves):
+        return
     try:
         from sequential_thinking_mongodb import get_sequential_thinking_manager
         manager = get_sequential_thinking_manager()
-        manager.save_thoughts(session_id, thoughts)
-        # Also save to file as backup
-        _save_thoughts_to_file(session_id, thoughts)
-    except:
-        _save_thoughts_to_file(session_id, thoughts)
+    except Exception as e:
+        logger.warning("Thoughts kept in the file backup only: %s", e)
+        _NEEDS_FULL_SAVE.update(session_id for session_id, *_ in appends + saves)
+        return
+    
+    for session_id, thoughts, latest in appends:
+        try:
+            appended = all(manager.append_thought(session_id, thought) for thought in thoughts)
+        except Exception as e:
+            logger.warning("Appending thoughts for session %s failed: %s", session_id, e)
+            appended = False
+        if not appended:
+            # MongoDB is missing earlier steps (or the append failed), so a
+            # partial push would hide the rest; overwrite with the full list
+            saves.append((session_id, latest))
+    if not saves:
+        return
+    try:
+        saved = manager.save_thoughts_bulk(saves)
+    except Exception:
+        saved = False
+    if saved:
+        _NEEDS_FULL_SAVE.difference_update(session_id for session_id, _ in saves)
+        return
+    # Retry one session at a time so a single failure stays contained
+    for session_id, thoughts in saves:
+        try:
+            saved = manager.save_thoughts(session_id, thoughts)
+        except Exception as e:
+            logger.warning("Saving thoughts for session %s failed: %s", session_id, e)
+            saved = False
+        if saved:
+            _NEEDS_FULL_SAVE.discard(session_id)
+        else:
+            logger.warning("Thoughts for session %s kept in the file backup only", session_id)
+            _NEEDS_FULL_SAVE.add(session_id)
+
+# Session ids become file names, so they may not contain path separators
+_SESSION_ID_RE = re.compile(r'[A-Za-z0-9_.-]{1,128}')
+
+@functools.lru_cache(maxsize=1024)
+def _path_for(session_id: str) -> pathlib.Path:
+    """Backup file for a session, validating the id once per distinct session."""
+    if not _SESSION_ID_RE.fullmatch(session_id):
+        raise ValueError(f"Invalid session_id: {session_id!r}")
+    return PERSIST_DIR / f"{session_id}.jsonl"
+
+def _step_of(thought: Dict[str, Any]) -> int:
+    """Sort key for thoughts (0 when a stored thought has no step)."""
+    return thought.get("step", 0)
 
 def _load_thoughts_from_file(session_id: str) -> List[Dict[str, Any]]:
     """Load thoughts from file storage."""
     try:
-        file_path = PERSIST_DIR / f"{session_id}.jsonl"
+        file_path = _path_for(session_id)
         if not file_path.exists():
             return []
         
-        thoughts = []
-        with open(file_path, 'r', encoding='utf-8') as f:
-            for line in f:
-                line = line.strip()
-                if line:
-                    thoughts.append(json.loads(line))
+        # One read, then parse each non-empty line straight from bytes
+        thoughts = [_json_loads(line) for line in file_path.read_bytes().split(b'\n') if line]
         
-        return sorted(thoughts, key=lambda x: x.get("step", 0))
+        # Files are written in step order, and an in-place timsort of sorted
+        # input is a single linear pass
+        thoughts.sort(key=_step_of)
+        return thoughts
     except Exception as e:
-        print(f"❌ Error loading thoughts from file for session {session_id}: {e}")
+        logger.error("Error loading thoughts from file for session %s: %s", session_id, e)
         return []
 
 def _save_thoughts_to_file(session_id: str, thoughts: List[Dict[str, Any]]):
     """Save thoughts to file storage."""
     try:
-        file_path = PERSIST_DIR / f"{session_id}.jsonl"
-        with open(file_path, 'w', encoding='utf-8') as f:
-            for thought in thoughts:
-                f.write(json.dumps(thought) + '\n')
-        print(f"✅ Saved {len(thoughts)} thoughts to file for session {session_id}")
+        file_path = _path_for(session_id)
+        # Write a temp file and swap it in, so a crash mid-write never
+        # leaves a truncated backup
+        tmp_path = file_path.with_suffix(".jsonl.tmp")
+        payload = b''.join(_json_line(thought) for thought in thoughts)
+        fd = os.open(tmp_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            view = memoryview(payload)
+            while view:
+                view = view[os.write(fd, view):]
+            # Data must be on disk before the rename makes it the backup
+            (os.fdatasync if hasattr(os, "fdatasync") else os.fsync)(fd)
+        finally:
+            os.close(fd)
+        os.replace(tmp_path, file_path)
+        logger.debug("Saved %d thoughts to file for session %s", len(thoughts), session_id)
     except Exception as e:
-        print(f"❌ Error saving thoughts to file for session {session_id}: {e}")
+        logger.error("Error saving thoughts to file for session %s: %s", session_id, e)
+
+def _append_thoughts_to_file(session_id: str, new_thoughts: List[Dict[str, Any]],
+                             thoughts: List[Dict[str, Any]]):
+    """Append new thoughts to the session's file; rewrites it (from `thoughts`) if it's missing."""
+    try:
+        file_path = _path_for(session_id)
+        if len(thoughts) > len(new_thoughts) and not file_path.exists():
+            # e.g. the session was loaded from MongoDB - back up everything
+            _save_thoughts_to_file(session_id, thoughts)
+            return
+        with open(file_path, 'ab', buffering=1 << 16) as f:
+            f.write(b''.join(_json_line(thought) for thought in new_thoughts))
+    except Exception as e:
+        logger.error("Error appending thoughts to file for session %s: %s", session_id, e)
+
+# Random UUIDs drawn from one os.urandom read per UUID_BATCH ids
+UUID_BATCH = 256
+_UUID_POOL: deque = deque()
+
+def _next_uuid() -> str:
+    """Random (version 4) UUID string, refilling the pool in batches."""
+    while True:
+        try:
+            return _UUID_POOL.popleft()
+        except IndexError:
+            raw = os.urandom(16 * UUID_BATCH)
+            _UUID_POOL.extend(str(uuid.UUID(bytes=raw[i:i + 16], version=4))
+                              for i in range(0, len(raw), 16))
+
+# A forked child would otherwise hand out the same ids as its parent
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_UUID_POOL.clear)
 
 def _add_thought(
     session_id: str,
@@ -904,7 +1653,7 @@ def _add_thought(
     thoughts = _load_thoughts(session_id)
     
     # Check token budget
-    current_tokens = sum(_tokens(t["text"]) for t in thoughts)
+    current_tokens = _session_tokens(session_id, thoughts)
     if current_tokens + _tokens(text) > MAX_TOKENS:
         raise ValueError("Token budget exceeded")
     
@@ -913,31 +1662,34 @@ def _add_thought(
     
     # Check for duplicates
     duplicate_threshold = 0.92
-    contradiction_keywords = ["however", "but", "actually", "wait", "no"]
-    is_contradiction = any(keyword in text.lower() for keyword in contradiction_keywords)
+    is_contradiction = _CONTRADICTION_RE.search(text) is not None
     
+    semantic_id = _semantic_hash(text)
     if thoughts and _embed is not None and not is_contradiction:
-        last_text = thoughts[-1]["text"]
-        similarity = _similarity(last_text, text)
+        # Compare against every prior thought, not just the last one
+        closest, similarity = _closest_thought(thoughts, text, semantic_id)
         if similarity > duplicate_threshold:
-            # Merge with last thought
-            thoughts[-1]["text"] += f"\n[merged] {text}"
-            thoughts[-1]["timestamp"] = int(time.time())
+            # Merge with the matching thought
+            thoughts[closest]["text"] += f"\n[merged] {text}"
+            thoughts[closest]["timestamp"] = int(time.time())
             _save_thoughts(session_id, thoughts)
-            return thoughts[-1]
+            return thoughts[closest]
     
     # Create new thought
     new_thought = {
         "step": len(thoughts),
         "text": text,
         "timestamp": int(time.time()),
-        "uuid": str(uuid.uuid4()),
-        "semantic_id": _semantic_hash(text),
-        "confidence": 0.95
+        "uuid": _next_uuid(),
+        "semantic_id": semantic_id,
+        "confidence": 0.95,
+        "depth": 0
     }
     
     if operation == "append" or branch_from is None:
         thoughts.append(new_thought)
+        _append_thought(session_id, new_thought, thoughts)
+        return new_thought
     elif operation == "revise":
         if 0 <= branch_from < len(thoughts):
             thoughts[branch_from].update({
@@ -948,8 +1700,12 @@ def _add_thought(
             raise IndexError("Invalid branch_from index")
     elif operation == "branch":
         if 0 <= branch_from < len(thoughts):
+            parent = thoughts[branch_from]
             new_thought["parent"] = branch_from
+            new_thought["depth"] = parent.get("depth", 0 if parent.get("parent") is None else 1) + 1
             thoughts.append(new_thought)
+            _append_thought(session_id, new_thought, thoughts)
+            return new_thought
         else:
             raise IndexError("Invalid branch_from index")
     else:
@@ -964,13 +1720,13 @@ def _format_thoughts(session_id: str) -> str:
     if not thoughts:
         return "No thoughts recorded yet."
     
-    lines = []
-    for thought in thoughts:
-        prefix = f"{thought['step']:02d}"
-        if thought.get("parent") is not None:
-            prefix += f"→{thought['parent']}"
-        indent = "  " * prefix.count("→")
-        lines.append(f"{indent}{prefix}: {thought['text']}")
+    lines = [None] * len(thoughts)
+    for i, thought in enumerate(thoughts):
+        parent = thought.get("parent")
+        # Thoughts saved before depth was recorded sit one level under their parent
+        depth = thought.get("depth", 0 if parent is None else 1)
+        branch = "" if parent is None else f"→{parent}"
+        lines[i] = f"{'':{depth * 2}}{thought['step']:02d}{branch}: {thought['text']}"
     
     return "\n".join(lines)
 
@@ -991,8 +1747,10 @@ def sequential_think(
     - operation: "append", "revise", or "branch"
     """
     try:
-        if not thought.strip():
+        if not thought or thought.isspace():
             return "Please provide a non-empty thought."
+        _path_for(session_id)  # rejects ids that aren't safe file names
+        thought = thought.strip()
         
         # Parse branch_from
         branch_from_int = None
@@ -1002,7 +1760,7 @@ def sequential_think(
             except (ValueError, TypeError):
                 return "Invalid branch_from value. Use integer or 'None'."
         
-        _add_thought(session_id, thought.strip(), branch_from_int, operation)
+        _add_thought(session_id, thought, branch_from_int, operation)
         return _format_thoughts(session_id)
         
     except Exception as e:
@@ -1018,9 +1776,9 @@ def sequential_review(session_id: str = "default", clear: bool = False) -> str:
     - clear: If True, clear the session data
     """
     try:
+        _path_for(session_id)  # rejects ids that aren't safe file names
         if clear:
-            file_path = PERSIST_DIR / f"{session_id}.jsonl"
-            file_path.unlink(missing_ok=True)
+            _clear_thoughts(session_id)
             return f"Session '{session_id}' cleared."
         
         return _format_thoughts(session_id)
@@ -1031,17 +1789,10 @@ def sequential_review(session_id: str = "default", clear: bool = False) -> str:
 # ------------------------------------------------
 #  Image Generation with OpenAI DALL-E 3
 # ------------------------------------------------
-@tool
-def generate_image(prompt: str) -> str:
-    """
-    Generate an image using OpenAI DALL-E 3.
-    Requires OPENAI_API environment variable.
-    """
-    openai_key = os.getenv("OPENAI_API")
-    if not openai_key:
-        return """Image Generation Requested
+# Fixed replies for the no-key and billing-limit cases; {PROMPT} is filled per call
+_IMG_UNAVAILABLE_TMPL = """Image Generation Requested
 
-Your Prompt: "{}"
+Your Prompt: "{PROMPT}"
 
 Service Currently Unavailable
 Image generation requires an OpenAI API key with available credits.
@@ -1053,11 +1804,43 @@ Alternative Options:
 • Check out Bing Image Creator: https://www.bing.com/images/create
 
 To Enable This Feature:
-Add your OpenAI API key to the .env file as OPENAI_API=your_key_here""".format(prompt)
+Add your OpenAI API key to the .env file as OPENAI_API=your_key_here"""
+
+_IMG_BILLING_TMPL = """Image Generation Requested
+
+Your Prompt: {PROMPT}
+
+OpenAI Billing Limit Reached
+The current OpenAI API key has reached its billing limit.
+
+Alternative Options:
+• Visit DALL-E 2 directly: https://openai.com/dall-e-2/
+• Try Midjourney: https://midjourney.com/
+• Use Stable Diffusion: https://stablediffusionweb.com/
+• Check out Bing Image Creator: https://www.bing.com/images/create
+
+To Fix This:
+Add credits to your OpenAI account or use a different API key."""
+
+# DALL-E image URLs expire after an hour, so cached results are dropped well before.
+# Exact prompts only: near-duplicates ("a red car" / "a blue car") want different images
+@tool
+@_semantic_cached("generate_image", ttl=3000, threshold=None, maxsize=256,
+                  error_prefixes=("Image Generation Requested", "Please provide",
+                                  "Image generation failed", "Network error"))
+def generate_image(prompt: str) -> str:
+    """
+    Generate an image using OpenAI DALL-E 3.
+    Requires OPENAI_API environment variable.
+    """
+    openai_key = os.getenv("OPENAI_API")
+    if not openai_key:
+        return _IMG_UNAVAILABLE_TMPL.replace("{PROMPT}", prompt)
     
     try:
-        if not prompt.strip():
+        if not prompt or prompt.isspace():
             return "Please provide an image description."
+        cleaned = prompt.strip()
         
         headers = {
             "Authorization": f"Bearer {openai_key}",
@@ -1066,22 +1849,22 @@ Add your OpenAI API key to the .env file as OPENAI_API=your_key_here""".format(p
         
         payload = {
             "model": "dall-e-3",
-            "prompt": prompt.strip(),
+            "prompt": cleaned,
             "n": 1,
             "size": "1024x1024",
             "quality": "standard",
             "response_format": "url"
         }
         
-        response = requests.post(
+        response = _SESSION.post(
             "https://api.openai.com/v1/images/generations",
             headers=headers,
-            json=payload,
+            data=_json_dumps(payload),
             timeout=60
         )
         
         if response.status_code == 200:
-            data = response.json()
+            data = _json_loads(response.content)
             image_url = data['data'][0]['url']
             
             return f"""Image Generated Successfully
@@ -1095,24 +1878,10 @@ Direct Link: {image_url}
 Note: This image URL is temporary and will expire after some time."""
         
         else:
-            error_data = response.json() if response.headers.get('content-type', '').startswith('application/json') else response.text
+            error_data = _json_loads(response.content) if response.headers.get('content-type', '').startswith('application/json') else response.text
             
             if "billing_hard_limit_reached" in str(error_data):
-                return f"""Image Generation Requested
-
-Your Prompt: {prompt}
-
-OpenAI Billing Limit Reached
-The current OpenAI API key has reached its billing limit.
-
-Alternative Options:
-• Visit DALL-E 2 directly: https://openai.com/dall-e-2/
-• Try Midjourney: https://midjourney.com/
-• Use Stable Diffusion: https://stablediffusionweb.com/
-• Check out Bing Image Creator: https://www.bing.com/images/create
-
-To Fix This:
-Add credits to your OpenAI account or use a different API key."""
+                return _IMG_BILLING_TMPL.replace("{PROMPT}", prompt)
             
             return f"Image generation failed: {error_data}"
             
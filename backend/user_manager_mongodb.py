@@ -3,45 +3,111 @@ MongoDB User Manager - Handles user authentication and management with MongoDB
 """
 import time
 import uuid
+from datetime import datetime, timedelta, timezone
 import hashlib
-import os
-from typing import Dict, List, Any, Optional
-from mongodb_manager import get_mongodb
+import hmac
+import secrets
+from functools import lru_cache
+from typing import Dict, List, Any, Optional, Union
+from mongodb_manager import get_mongodb, FAST_WRITE_CONCERN
+from pymongo.collation import Collation
 from pymongo.errors import DuplicateKeyError
 
+try:
+    from argon2 import PasswordHasher
+    from argon2.exceptions import InvalidHashError, VerificationError
+    _ARGON2_AVAILABLE = True
+except ImportError:
+    _ARGON2_AVAILABLE = False
+
+# Case-insensitive comparison for usernames and emails; queries must pass the
+# same collation as the indexes below for MongoDB to use them
+CASE_INSENSITIVE = Collation(locale="en", strength=2)
+
+# Auth tokens are valid for 24 hours; MongoDB's TTL monitor deletes them after that
+AUTH_TOKEN_TTL_SECONDS = 86400
+MAX_TOKENS_PER_USER = 5
+
+# PBKDF2 fallback parameters (used only when argon2-cffi isn't installed)
+PBKDF2_ITERATIONS = 100000
+PBKDF2_SALT_BYTES = 16  # NIST SP 800-132 minimum
+
+@lru_cache(maxsize=1024)
+def _parse_pbkdf2_hash(stored_hash: str):
+    """Decode a legacy 'salt:key' hex hash once per distinct hash string"""
+    salt_hex, key_hex = stored_hash.split(':')
+    return bytes.fromhex(salt_hex), bytes.fromhex(key_hex)
+
 class MongoUserManager:
     """
     Manages user accounts and authentication using MongoDB
     """
     def __init__(self):
         self.mongodb = get_mongodb()
-        self.users_collection = self.mongodb.get_collection("users")
-        self.sessions_collection = self.mongodb.get_collection("sessions")
+        self.users_collection = self.mongodb.users
+        self.sessions_collection = self.mongodb.sessions
+        self.tokens_collection = self.mongodb.get_collection("auth_tokens")
+        
+        # Same collections with an unjournaled write concern for hot-path writes;
+        # registration keeps the default
+        self._users_fast = self._fast(self.users_collection)
+        self._tokens_fast = self._fast(self.tokens_collection)
+        
+        # argon2id for new hashes; legacy PBKDF2 "salt:key" hashes are still
+        # verified and upgraded on the next successful login
+        self._ph = PasswordHasher(time_cost=2, memory_cost=64 * 1024, parallelism=1) if _ARGON2_AVAILABLE else None
         
         if not self.mongodb.is_connected():
             print("❌ MongoDB not connected - User Manager will not work properly")
         else:
+            self._ensure_indexes()
             print("✅ MongoDB User Manager initialized successfully")
     
+    @staticmethod
+    def _fast(collection):
+        """Return `collection` with FAST_WRITE_CONCERN applied"""
+        if collection is None:
+            return None
+        return collection.with_options(write_concern=FAST_WRITE_CONCERN)
+    
+    def _ensure_indexes(self):
+        """Create the indexes behind the login, registration and token lookups"""
+        try:
+            self.users_collection.create_index(
+                [("username", 1)], unique=True, collation=CASE_INSENSITIVE, name="uniq_username_ci"
+            )
+            self.users_collection.create_index(
+                [("email", 1)], unique=True, collation=CASE_INSENSITIVE, name="uniq_email_ci"
+            )
+        except Exception as e:
+            print(f"⚠️ Warning: Could not create users indexes: {e}")
+        
+        try:
+            # One document per token ({_id: token, user_id, created_at}); created_at
+            # must be a BSON date for the TTL index to expire it
+            self.tokens_collection.create_index(
+                "created_at", expireAfterSeconds=AUTH_TOKEN_TTL_SECONDS, name="auth_token_ttl"
+            )
+            self.tokens_collection.create_index(
+                [("user_id", 1), ("created_at", -1)], name="user_tokens_idx"
+            )
+        except Exception as e:
+            print(f"⚠️ Warning: Could not create auth token indexes: {e}")
+    
     def register_user(self, username: str, email: str, password: str) -> Dict[str, Any]:
         """Register a new user"""
         if not self.mongodb.is_connected():
             raise ValueError("Database connection not available")
         
         try:
-            # Check if username or email already exists
-            existing_user = self.users_collection.find_one({
-                "$or": [
-                    {"username": {"$regex": f"^{username}$", "$options": "i"}},
-                    {"email": {"$regex": f"^{email}$", "$options": "i"}}
-                ]
-            })
-            
-            if existing_user:
-                if existing_user.get("username", "").lower() == username.lower():
-                    raise ValueError("Username already exists")
-                else:
-                    raise ValueError("Email already exists")
+            # Fast-path check if username or email already exists; the unique
+            # indexes (DuplicateKeyError below) are the race-free authority
+            if self.users_collection.find_one({"username": username}, projection={"_id": 1},
+                                              collation=CASE_INSENSITIVE):
+                raise ValueError("Username already exists")
+            if self.users_collection.find_one({"email": email}, projection={"_id": 1},
+                                              collation=CASE_INSENSITIVE):
+                raise ValueError("Email already exists")
             
             # Create user ID and hash password
             user_id = str(uuid.uuid4())
@@ -55,8 +121,7 @@ class MongoUserManager:
                 "email": email,
                 "password_hash": password_hash,
                 "created_at": timestamp,
-                "last_login": timestamp,
-                "auth_tokens": []
+                "last_login": timestamp
             }
             
             # Insert user into database
@@ -78,8 +143,15 @@ class MongoUserManager:
                 "auth_token": auth_token
             }
             
-        except DuplicateKeyError:
+        except DuplicateKeyError as e:
+            key_pattern = (e.details or {}).get("keyPattern", {})
+            if "username" in key_pattern:
+                raise ValueError("Username already exists")
+            if "email" in key_pattern:
+                raise ValueError("Email already exists")
             raise ValueError("Username or email already exists")
+        except ValueError:
+            raise
         except Exception as e:
             print(f"❌ Error registering user: {e}")
             raise ValueError(f"Registration failed: {str(e)}")
@@ -91,9 +163,9 @@ class MongoUserManager:
         
         try:
             # Find user by username (case-insensitive)
-            user_doc = self.users_collection.find_one({
-                "username": {"$regex": f"^{username}$", "$options": "i"}
-            })
+            user_doc = self.users_collection.find_one(
+                {"username": username}, collation=CASE_INSENSITIVE
+            )
             
             if not user_doc:
                 raise ValueError("Invalid username or password")
@@ -102,11 +174,14 @@ class MongoUserManager:
             if not self._verify_password(password, user_doc["password_hash"]):
                 raise ValueError("Invalid username or password")
             
-            # Update last login
+            # Update last login (and upgrade a legacy password hash in the same write)
             timestamp = time.time()
-            self.users_collection.update_one(
+            updates = {"last_login": timestamp}
+            if self._needs_rehash(user_doc["password_hash"]):
+                updates["password_hash"] = self._hash_password(password)
+            self._users_fast.update_one(
                 {"_id": user_doc["_id"]},
-                {"$set": {"last_login": timestamp}}
+                {"$set": updates}
             )
             
             # Create and store new auth token
@@ -137,33 +212,33 @@ class MongoUserManager:
             return None
         
         try:
-            # Find user with this auth token
-            user_doc = self.users_collection.find_one({
-                "auth_tokens.token": auth_token
-            })
+            # Resolve token -> user server-side in one round trip. The TTL
+            # monitor only runs once a minute, so also filter on age
+            pipeline = [
+                {"$match": {
+                    "_id": auth_token,
+                    "created_at": {"$gt": datetime.now(timezone.utc) - timedelta(seconds=AUTH_TOKEN_TTL_SECONDS)}
+                }},
+                {"$lookup": {
+                    "from": self.users_collection.name,
+                    "localField": "user_id",
+                    "foreignField": "_id",
+                    "as": "user"
+                }},
+                {"$unwind": "$user"},
+                {"$project": {
+                    "_id": "$user._id",
+                    "username": "$user.username",
+                    "email": "$user.email",
+                    "created_at": "$user.created_at",
+                    "last_login": "$user.last_login"
+                }}
+            ]
+            user_doc = next(self.tokens_collection.aggregate(pipeline), None)
             
             if not user_doc:
                 return None
             
-            # Check if token is still valid (24 hours)
-            token_data = None
-            for token in user_doc.get("auth_tokens", []):
-                if token["token"] == auth_token:
-                    token_data = token
-                    break
-            
-            if not token_data:
-                return None
-            
-            # Check token expiry (24 hours = 86400 seconds)
-            if time.time() - token_data["created_at"] > 86400:
-                # Remove expired token
-                self.users_collection.update_one(
-                    {"_id": user_doc["_id"]},
-                    {"$pull": {"auth_tokens": {"token": auth_token}}}
-                )
-                return None
-            
             # Return user data without password hash and tokens
             return {
                 "id": user_doc["_id"],
@@ -183,12 +258,9 @@ class MongoUserManager:
             return False
         
         try:
-            result = self.users_collection.update_one(
-                {"auth_tokens.token": auth_token},
-                {"$pull": {"auth_tokens": {"token": auth_token}}}
-            )
+            result = self.tokens_collection.delete_one({"_id": auth_token})
             
-            return result.modified_count > 0
+            return result.deleted_count > 0
             
         except Exception as e:
             print(f"❌ Error during logout: {e}")
@@ -197,46 +269,69 @@ class MongoUserManager:
     def _store_auth_token(self, user_id: str, auth_token: str):
         """Store auth token for user"""
         try:
-            # Clean up old tokens (keep only last 5)
-            user_doc = self.users_collection.find_one({"_id": user_id})
-            if user_doc and len(user_doc.get("auth_tokens", [])) >= 5:
-                # Remove oldest tokens
-                self.users_collection.update_one(
-                    {"_id": user_id},
-                    {"$pop": {"auth_tokens": -1}}  # Remove from beginning (oldest)
-                )
-            
-            # Add new token
-            token_data = {
-                "token": auth_token,
-                "created_at": time.time()
-            }
-            
-            self.users_collection.update_one(
-                {"_id": user_id},
-                {"$push": {"auth_tokens": token_data}}
+            # Clean up old tokens (keep only last 5, including the new one). The
+            # cutoff lookup is covered by user_tokens_idx and returns at most one
+            # date, so the common case is one tiny read plus the insert
+            cutoff = self.tokens_collection.find_one(
+                {"user_id": user_id},
+                projection={"_id": 0, "created_at": 1},
+                sort=[("created_at", -1)],
+                skip=MAX_TOKENS_PER_USER - 1
             )
+            if cutoff:
+                self._tokens_fast.delete_many({
+                    "user_id": user_id,
+                    "created_at": {"$lte": cutoff["created_at"]}
+                })
+            
+            self._tokens_fast.insert_one({
+                "_id": auth_token,
+                "user_id": user_id,
+                "created_at": datetime.now(timezone.utc)
+            })
             
         except Exception as e:
             print(f"❌ Error storing auth token: {e}")
     
-    def _hash_password(self, password: str) -> str:
+    def _hash_password(self, password: str) -> Union[str, Dict[str, Any]]:
         """Hash a password"""
-        salt = os.urandom(32)
+        if self._ph is not None:
+            return self._ph.hash(password)
+        
+        # Salt and key are stored as BSON binary, so verifying needs no parsing
+        salt = secrets.token_bytes(PBKDF2_SALT_BYTES)
         key = hashlib.pbkdf2_hmac(
             'sha256',
             password.encode('utf-8'),
             salt,
-            100000
+            PBKDF2_ITERATIONS
         )
-        return salt.hex() + ':' + key.hex()
+        return {"algo": "pbkdf2-sha256", "salt": salt, "key": key, "iters": PBKDF2_ITERATIONS}
     
-    def _verify_password(self, password: str, stored_hash: str) -> bool:
+    def _verify_password(self, password: str, stored_hash: Union[str, Dict[str, Any]]) -> bool:
         """Verify a password against a stored hash"""
+        if isinstance(stored_hash, dict):
+            try:
+                key = hashlib.pbkdf2_hmac(
+                    'sha256',
+                    password.encode('utf-8'),
+                    stored_hash["salt"],
+                    stored_hash["iters"]
+                )
+                return hmac.compare_digest(key, stored_hash["key"])
+            except Exception:
+                return False
+        
+        if stored_hash.startswith("$argon2"):
+            if self._ph is None:
+                return False
+            try:
+                return self._ph.verify(stored_hash, password)
+            except (VerificationError, InvalidHashError):
+                return False
+        
         try:
-            salt_hex, key_hex = stored_hash.split(':')
-            salt = bytes.fromhex(salt_hex)
-            stored_key = bytes.fromhex(key_hex)
+            salt, stored_key = _parse_pbkdf2_hash(stored_hash)
             
             key = hashlib.pbkdf2_hmac(
                 'sha256',
@@ -245,10 +340,19 @@ class MongoUserManager:
                 100000
             )
             
-            return key == stored_key
+            # Constant-time comparison
+            return hmac.compare_digest(key, stored_key)
         except Exception:
             return False
     
+    def _needs_rehash(self, stored_hash: Union[str, Dict[str, Any]]) -> bool:
+        """Whether a stored hash should be replaced with a current argon2id hash"""
+        if self._ph is None:
+            return False
+        if isinstance(stored_hash, dict) or not stored_hash.startswith("$argon2"):
+            return True
+        return self._ph.check_needs_rehash(stored_hash)
+    
     def _generate_auth_token(self) -> str:
         """Generate a new auth token"""
         return str(uuid.uuid4())
@@ -259,10 +363,16 @@ class MongoUserManager:
             return {"error": "Database not connected"}
         
         try:
-            total_users = self.users_collection.count_documents({})
-            active_sessions = self.users_collection.count_documents({
-                "auth_tokens": {"$exists": True, "$ne": []}
-            })
+            # Collection metadata count, no scan
+            total_users = self.users_collection.estimated_document_count()
+            # Count users holding a token server-side; grouping on the leading
+            # field of user_tokens_idx is an index-only DISTINCT_SCAN and avoids
+            # shipping every user id back just to len() it
+            active = next(self.tokens_collection.aggregate([
+                {"$group": {"_id": "$user_id"}},
+                {"$count": "users"}
+            ], hint="user_tokens_idx"), None)
+            active_sessions = active["users"] if active else 0
             
             return {
                 "total_users": total_users,